@@ -0,0 +1,475 @@
+# bench_m3.py (m3-download)
+"""
+Benchmark the digest, URL resolution and download stages against a local stand-in for M3
+"""
+import argparse
+import configparser
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+import numpy as np
+import requests
+from PIL import Image
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)  # Repository root, for lib and the pipeline scripts
+
+import download_images  # noqa: E402
+import extract_localizations  # noqa: E402
+import generate_digest  # noqa: E402
+from lib.cache import configure_cache  # noqa: E402
+from lib.config import Config  # noqa: E402
+from lib.image_index import ImageIndex  # noqa: E402
+
+ROOT_CONCEPT = 'Benchconcept'
+UUID_NAMESPACE = uuid.UUID('6f1d2c1e-6a4b-4c0e-9a52-3b1f5e0c7d10')
+LOCALIZATIONS_FILENAME = 'localizations.json'
+URL_MAP_FILENAME = 'url_map.json'
+IMAGES_DIRNAME = 'images'
+
+
+def make_uuid(*parts) -> str:
+    return str(uuid.uuid5(UUID_NAMESPACE, '/'.join(map(str, parts))))
+
+
+class FakeM3:
+    """
+    Deterministic M3 data set: a root concept with descendants, each with observations in their own imaged moment
+    Each imaged moment has one image reference and some extra observations of other concepts
+    """
+
+    def __init__(self, n_concepts: int, n_observations: int, n_extra: int, image_bytes: bytes, base_url: str):
+        self.base_url = base_url
+        self.image_bytes = image_bytes
+        self.concepts = [ROOT_CONCEPT] + ['{} {}'.format(ROOT_CONCEPT, i) for i in range(n_concepts)]
+        self.n_observations = n_observations
+        self.n_extra = n_extra
+
+        self.imaged_moments = {}  # Imaged moment UUID -> (concept index, observation index)
+        self.image_references = {}
+        for concept_idx in range(len(self.concepts)):
+            for obs_idx in range(n_observations):
+                self.imaged_moments[make_uuid('im', concept_idx, obs_idx)] = (concept_idx, obs_idx)
+                self.image_references[make_uuid('ir', concept_idx, obs_idx)] = (concept_idx, obs_idx)
+
+    def image_reference(self, concept_idx, obs_idx):
+        image_reference_uuid = make_uuid('ir', concept_idx, obs_idx)
+        return {
+            'uuid': image_reference_uuid,
+            'url': '{}/images/{}.png'.format(self.base_url, image_reference_uuid),
+            'format': 'image/png'
+        }
+
+    def observation(self, concept_idx, obs_idx, extra_idx=None):
+        concept = self.concepts[concept_idx] if extra_idx is None else 'Other {}'.format(extra_idx)
+        box = {
+            'x': 10 + obs_idx % 50,
+            'y': 20 + obs_idx % 30,
+            'width': 40,
+            'height': 30,
+            'image_reference_uuid': make_uuid('ir', concept_idx, obs_idx)
+        }
+        return {
+            'uuid': make_uuid('obs', concept_idx, obs_idx, extra_idx),
+            'concept': concept,
+            'observer': 'bench',
+            'activity': 'stationary',
+            'associations': [{
+                'uuid': make_uuid('assoc', concept_idx, obs_idx, extra_idx),
+                'link_name': 'bounding box',
+                'to_concept': 'self',
+                'link_value': json.dumps(box),
+                'mime_type': 'application/json'
+            }]
+        }
+
+    def imaged_moment(self, imaged_moment_uuid):
+        concept_idx, obs_idx = self.imaged_moments[imaged_moment_uuid]
+        observations = [self.observation(concept_idx, obs_idx)]
+        observations += [self.observation(concept_idx, obs_idx, extra_idx) for extra_idx in range(self.n_extra)]
+        return {
+            'uuid': imaged_moment_uuid,
+            'video_reference_uuid': make_uuid('vr', concept_idx),
+            'recorded_date': '2020-01-01T00:00:{:02d}Z'.format(obs_idx % 60),
+            'observations': observations,
+            'image_references': [self.image_reference(concept_idx, obs_idx)]
+        }
+
+    def concept_images(self, concept):
+        if concept not in self.concepts:
+            return []
+        concept_idx = self.concepts.index(concept)
+
+        results = []
+        for obs_idx in range(self.n_observations):
+            imaged_moment_uuid = make_uuid('im', concept_idx, obs_idx)
+            observation = self.observation(concept_idx, obs_idx)
+            imaged_moment = self.imaged_moment(imaged_moment_uuid)
+            results.append({
+                'observation_uuid': observation['uuid'],
+                'concept': observation['concept'],
+                'observer': observation['observer'],
+                'video_reference_uuid': imaged_moment['video_reference_uuid'],
+                'imaged_moment_uuid': imaged_moment_uuid,
+                'associations': observation['associations'],
+                'image_references': imaged_moment['image_references'],
+                'recorded_timestamp': imaged_moment['recorded_date']
+            })
+        return results
+
+    def descendants(self, concept):
+        if concept != ROOT_CONCEPT:
+            return {'name': concept, 'children': []}
+        return {'name': concept, 'children': [{'name': c, 'children': []} for c in self.concepts[1:]]}
+
+    def route(self, path: str):
+        """ Returns (status, content type, body) for a request path """
+        parts = [unquote(part) for part in urlsplit(path).path.strip('/').split('/')]
+        key = parts[-1]
+
+        if parts[:2] == ['images', key]:
+            return 200, 'image/png', self.image_bytes
+        if parts[:-1] == ['anno', 'v1', 'fast', 'concept', 'images']:
+            data = self.concept_images(key)
+        elif parts[:-1] == ['kb', 'v1', 'phylogeny', 'down']:
+            data = self.descendants(key)
+        elif parts[:-1] == ['anno', 'v1', 'imagedmoments'] and key in self.imaged_moments:
+            data = self.imaged_moment(key)
+        elif parts[:-1] == ['anno', 'v1', 'imagereferences'] and key in self.image_references:
+            data = self.image_reference(*self.image_references[key])
+        else:
+            return 404, 'application/json', b'{"error": "not found"}'
+
+        return 200, 'application/json', json.dumps(data).encode('utf-8')
+
+
+def make_image_bytes(image_kb: int) -> bytes:
+    """ Encode a noise PNG of roughly `image_kb` kilobytes (noise does not compress) """
+    side = max(int((image_kb * 1024 / 3) ** 0.5), 1)
+    pixels = np.random.default_rng(0).integers(0, 256, size=(side, side, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def serve(args, port_queue, n_requests, n_errors):
+    """ Run the fake M3 server (in its own process, so it does not compete with the client for the GIL) """
+    state = {}
+    rng = random.Random(args.seed)
+    rng_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive, like M3
+        disable_nagle_algorithm = True  # Headers and body are written separately
+
+        def do_GET(self):
+            with rng_lock:
+                delay = args.latency + rng.uniform(0, args.jitter)
+                fail = rng.random() < args.error_rate
+            time.sleep(delay / 1000)
+
+            with n_requests.get_lock():
+                n_requests.value += 1
+
+            if fail:
+                with n_errors.get_lock():
+                    n_errors.value += 1
+                status, content_type, body = 503, 'application/json', b'{"error": "injected"}'
+            else:
+                status, content_type, body = state['m3'].route(self.path)
+
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    ThreadingHTTPServer.request_queue_size = 256
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    state['m3'] = FakeM3(args.concepts, args.observations, args.extra, make_image_bytes(args.image_kb), base_url)
+
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def write_config(base_config_path: str, port: int, path: str):
+    """ Write a config pointing at the fake server, keeping the [http] settings of the base config """
+    parser = configparser.ConfigParser()
+    parser.read(base_config_path)
+    parser['m3'] = {
+        'site': 'http://127.0.0.1:{}'.format(port),
+        'anno': '%(site)s/anno/v1',
+        'kb': '%(site)s/kb/v1',
+        'fastconceptimages': '%(anno)s/fast/concept/images',
+        'kbdesc': '%(kb)s/phylogeny/down',
+        'imagedmoment': '%(anno)s/imagedmoments',
+        'imagereference': '%(anno)s/imagereferences'
+    }
+    parser['cache'] = {'enabled': 'false'}
+    with open(path, 'w') as f:
+        parser.write(f)
+
+
+def instrument_requests(latencies: list, failures: list):
+    """ Time every request sent by any session in this process (to response headers, after retries) """
+    send = requests.Session.send
+    lock = threading.Lock()
+
+    def timed_send(self, request, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            response = send(self, request, **kwargs)
+        except requests.RequestException:
+            with lock:
+                failures.append(1)
+            raise
+        with lock:
+            latencies.append(time.perf_counter() - t0)
+            if response.status_code >= 400:
+                failures.append(1)
+        return response
+
+    requests.Session.send = timed_send
+
+
+def peak_rss_mb() -> float:
+    """ Peak resident set size of this process """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024  # Bytes on macOS, KB elsewhere
+
+
+def run_digest(config, work_dir, concurrency):
+    generate_digest.main(ROOT_CONCEPT, config.path, True, True, concurrency=concurrency, use_cache=False)
+    with open(generate_digest.digest_path(ROOT_CONCEPT, True)) as f:
+        return len(json.load(f))
+
+
+def finish_digest(config, work_dir, concurrency):
+    extract_localizations.main([generate_digest.digest_path(ROOT_CONCEPT, True)], LOCALIZATIONS_FILENAME)
+
+
+def run_resolve(config, work_dir, concurrency):
+    with open(LOCALIZATIONS_FILENAME) as f:
+        image_reference_uuids = sorted(set(
+            loc['localization']['image_reference_uuid'] for loc in json.load(f)
+            if 'image_reference_uuid' in loc['localization']
+        ))
+
+    url_map = download_images.resolve_image_urls(config, image_reference_uuids, concurrency)
+    with open(URL_MAP_FILENAME, 'w') as f:
+        json.dump(url_map, f)
+    return len(url_map)
+
+
+def run_download(config, work_dir, concurrency):
+    with open(URL_MAP_FILENAME) as f:
+        url_map = json.load(f)
+
+    os.makedirs(IMAGES_DIRNAME, exist_ok=True)
+    filename_map = download_images.make_filename_map(url_map, IMAGES_DIRNAME)
+    iruuids = list(url_map)
+    urls = [url_map[iruuid] for iruuid in iruuids]
+    paths = [filename_map[iruuid] for iruuid in iruuids]
+
+    with ImageIndex.for_directory(IMAGES_DIRNAME) as image_index:
+        failures = download_images.download_images(iruuids, urls, paths, concurrency, config, image_index=image_index)
+    return len(urls) - len(failures)
+
+
+STAGES = (  # Name, timed function, untimed follow-up (preparing the next stage's input)
+    ('digest', run_digest, finish_digest),
+    ('resolve', run_resolve, None),
+    ('download', run_download, None)
+)
+
+
+def run_stage(stage_idx, config_path, work_dir, concurrency, verbose, result_queue):
+    """ Run one stage in a fresh process and report its timings, so peak RSS is measured per stage """
+    name, run, finish = STAGES[stage_idx]
+    os.chdir(work_dir)
+    config = Config(config_path)
+    configure_cache(config, enabled=False)
+
+    latencies = []
+    failures = []
+    instrument_requests(latencies, failures)
+
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    error = None
+    n_items = 0
+    with output:
+        t0 = time.perf_counter()
+        try:
+            n_items = run(config, work_dir, concurrency)
+        except (Exception, SystemExit) as e:
+            error = repr(e)
+        seconds = time.perf_counter() - t0
+        if finish is not None and error is None:
+            finish(config, work_dir, concurrency)
+
+    latencies_ms = np.array(latencies) * 1000
+    result_queue.put({
+        'seconds': round(seconds, 3),
+        'items': n_items,
+        'items_per_second': round(n_items / seconds, 2) if seconds else None,
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / seconds, 2) if seconds else None,
+        'failed_requests': len(failures),
+        'latency_ms': {
+            'mean': round(float(latencies_ms.mean()), 3) if len(latencies) else None,
+            'p50': round(float(np.percentile(latencies_ms, 50)), 3) if len(latencies) else None,
+            'p99': round(float(np.percentile(latencies_ms, 99)), 3) if len(latencies) else None
+        },
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'error': error
+    })
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    context = multiprocessing.get_context('fork')
+    port_queue = context.Queue()
+    n_requests = context.Value('l', 0)
+    n_errors = context.Value('l', 0)
+    server = context.Process(target=serve, args=(args, port_queue, n_requests, n_errors), daemon=True)
+    server.start()
+    port = port_queue.get()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_m3_')
+    config_path = os.path.join(work_dir, 'config.ini')
+    write_config(args.config, port, config_path)
+
+    report = {
+        'commit': get_commit(),
+        'python': sys.version.split()[0],
+        'params': {
+            'concepts': args.concepts,
+            'observations': args.observations,
+            'extra': args.extra,
+            'image_kb': args.image_kb,
+            'latency_ms': args.latency,
+            'jitter_ms': args.jitter,
+            'error_rate': args.error_rate,
+            'concurrency': args.concurrency
+        },
+        'stages': {}
+    }
+
+    try:
+        for stage_idx, (name, _, _) in enumerate(STAGES):
+            served_before, errors_before = n_requests.value, n_errors.value
+            result_queue = context.Queue()
+            process = context.Process(
+                target=run_stage, args=(stage_idx, config_path, work_dir, args.concurrency, args.verbose, result_queue)
+            )
+            process.start()
+            result = result_queue.get()
+            process.join()
+
+            result['server_requests'] = n_requests.value - served_before  # Including retries
+            result['server_errors_injected'] = n_errors.value - errors_before
+            report['stages'][name] = result
+            print('[INFO] {:<10} {:>8.2f} s {:>10} req/s p50 {} ms p99 {} ms'.format(
+                name, result['seconds'], result['requests_per_second'],
+                result['latency_ms']['p50'], result['latency_ms']['p99']
+            ), file=sys.stderr)
+
+            if result['error'] is not None:
+                print('[ERROR] Stage {} failed: {}'.format(name, result['error']), file=sys.stderr)
+                break
+    finally:
+        server.terminate()
+        if args.keep:
+            print('[INFO] Kept work directory {}'.format(work_dir), file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('[INFO] Wrote report to {}'.format(args.output), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    _parser = argparse.ArgumentParser(description=__doc__)
+    _parser.add_argument('-c', '--config',
+                         type=str,
+                         default=os.path.join(ROOT_DIR, 'config.ini'),
+                         help='Base config, whose [http] settings are used (default=repository config.ini)')
+    _parser.add_argument('-n', '--concurrency',
+                         type=int,
+                         default=8,
+                         help='Concurrent requests in the digest stage and download threads (default=8)')
+    _parser.add_argument('--concepts',
+                         type=int,
+                         default=8,
+                         help='Number of descendant concepts (default=8)')
+    _parser.add_argument('--observations',
+                         type=int,
+                         default=100,
+                         help='Observations (and images) per concept (default=100)')
+    _parser.add_argument('--extra',
+                         type=int,
+                         default=2,
+                         help='Extra observations of other concepts per imaged moment (default=2)')
+    _parser.add_argument('--image_kb',
+                         type=int,
+                         default=64,
+                         help='Approximate image size, in KB (default=64)')
+    _parser.add_argument('--latency',
+                         type=float,
+                         default=20,
+                         help='Server latency per request, in ms (default=20)')
+    _parser.add_argument('--jitter',
+                         type=float,
+                         default=5,
+                         help='Uniform random extra latency per request, up to this many ms (default=5)')
+    _parser.add_argument('--error_rate',
+                         type=float,
+                         default=0,
+                         help='Fraction of requests answered with 503 (default=0)')
+    _parser.add_argument('--seed',
+                         type=int,
+                         default=0,
+                         help='Random seed for latency jitter and errors (default=0)')
+    _parser.add_argument('-o', '--output',
+                         type=str,
+                         default=None,
+                         help='(optional) JSON report path (default=stdout)')
+    _parser.add_argument('-k', '--keep',
+                         action='store_true',
+                         help='Keep the temporary work directory (digest, localizations and images)')
+    _parser.add_argument('-v', '--verbose',
+                         action='store_true',
+                         help='Show the output of each stage')
+    main(_parser.parse_args())
@@ -4,68 +4,333 @@ Download images corresponding to localizations
 """
 
 import argparse
+import hashlib
 import json
 import os
-from multiprocessing import Pool
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
 
 import requests
+from PIL import UnidentifiedImageError
 
+from lib import metrics
+from lib.cache import configure_cache, print_cache_stats
 from lib.config import Config
+from lib.image_index import ImageIndex, probe_image
+from lib.journal import DownloadJournal, STATE_DONE, STATE_FAILED
 from lib.m3_requests import get_image_reference_data
+from lib.ratecontrol import print_rate_control_stats
+from lib.session import make_session, get_timeout
+from lib.store import ImageStore
+from lib.transcode import (DEFAULT_QUALITY, FORMATS as TRANSCODE_FORMATS, ScaleIndex, TranscodeOptions,
+                           TranscodePool, image_map_entry, image_map_path, source_path)
 
 IMAGE_MAP_FILENAME = 'image_map.json'
 DOWNLOAD_FAILURE_FILENAME = 'failures.csv'
+PARTIAL_SUFFIX = '.part'
+DOWNLOAD_CHUNK_SIZE = 256 * 1024  # Streaming buffer size, in bytes
+QUEUE_FACTOR = 4  # Downloads in flight per worker thread
 
+_thread_local = threading.local()  # Per-worker-thread state (session)
 
-def download_image(url, path):
-    res = requests.get(url, stream=True)  # stream=True so we don't load the whole thing into memory
-    if res.status_code == 200:
-        with open(path, 'wb') as f:
-            for chunk in res.iter_content(1024):
-                f.write(chunk)
-        return True
-    return False
 
+def get_worker_session(config):
+    """ Get the session owned by the current worker thread, creating it on first use """
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = make_session(config)
+        _thread_local.session = session
+    return session
 
-def download_helper(url_path_tup):
-    url, path = url_path_tup
-    return download_image(url, path)
 
+def fetch_image(config, url, temp_path, session=None):
+    """
+    Stream an image into `temp_path`
+    Returns (number of bytes written, SHA-256 hex digest), or None on failure
+    """
+    if session is None:
+        session = get_worker_session(config)
 
-def download_images(urls, paths, n_workers):
-    """ Download the images specified by `urls` to `paths` using `n_workers` """
-    # Zip the urls and paths for mapping
-    url_path_tups = list(zip(urls, paths))
+    t0 = time.perf_counter()
+    try:
+        # stream=True so we don't load the whole thing into memory
+        res = session.get(url, stream=True, timeout=get_timeout(config))
+    except requests.RequestException:
+        return None
+
+    sha256 = hashlib.sha256()
+    n_bytes = 0
+    with res:
+        if res.status_code != 200:
+            return None
+
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in res.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    n_bytes += len(chunk)
+        except (OSError, requests.RequestException):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+
+    metrics.record('http.image', time.perf_counter() - t0, n_bytes)
+    return n_bytes, sha256.hexdigest()
+
+
+def index_image(image_index, image_reference_uuid, path, n_bytes=None, sha256=None, checksum=True):
+    """ Record the metadata of an image in the index. Files that can't be identified as images are not indexed """
+    try:
+        image_index.add(image_reference_uuid, probe_image(path, n_bytes=n_bytes, sha256=sha256, checksum=checksum))
+    except (OSError, UnidentifiedImageError) as e:
+        print('[WARNING] Could not index image {}: {}'.format(path, e))
+
+
+def partial_path(path, image_reference_uuid=None):
+    """
+    Temporary path to download an image to before moving it to `path`
+    Image references with the same URL share a path, so concurrent downloads of them each get their own file
+    """
+    if image_reference_uuid is None:
+        return path + PARTIAL_SUFFIX
+    return '{}.{}{}'.format(path, image_reference_uuid, PARTIAL_SUFFIX)
+
+
+def download_image(config, url, path, session=None, store=None, image_index=None, image_reference_uuid=None):
+    """
+    Download an image to a temporary file, then atomically move it to `path`
+    If a store is given, the image is linked from the store instead (and only downloaded if not already stored)
+    If an image index is given, the image's metadata is recorded in it
+    Returns the number of bytes downloaded, or None on failure
+    """
+    if store is None:
+        temp_path = partial_path(path, image_reference_uuid)
+        result = fetch_image(config, url, temp_path, session=session)
+        if result is None:
+            return None
+
+        os.replace(temp_path, path)  # Never leave a truncated image at the final path
+        n_bytes, digest = result
+        if image_index is not None:
+            index_image(image_index, image_reference_uuid, path, n_bytes=n_bytes, sha256=digest)
+        return n_bytes
+
+    blob_path = store.lookup(image_reference_uuid)
+    if blob_path is not None:  # Already stored, no need to download
+        store.link(blob_path, path, image_reference_uuid)
+        if image_index is not None and image_reference_uuid not in image_index:
+            index_image(image_index, image_reference_uuid, path, sha256=store.digest(image_reference_uuid))
+        return 0
+
+    temp_path = os.path.join(store.path, image_reference_uuid + PARTIAL_SUFFIX)
+    result = fetch_image(config, url, temp_path, session=session)
+    if result is None:
+        return None
+
+    n_bytes, digest = result
+    blob_path = store.add(image_reference_uuid, temp_path, digest, ext=os.path.splitext(path)[1])
+    store.link(blob_path, path, image_reference_uuid)
+    if image_index is not None:
+        index_image(image_index, image_reference_uuid, path, n_bytes=n_bytes, sha256=digest)
+    return n_bytes
+
+
+def iter_downloads(config, work, n_workers, store=None, image_index=None):
+    """
+    Download each (image reference UUID, URL, path) in `work` using `n_workers` threads
+    Yields (image reference UUID, URL, path, bytes downloaded or None) as each download completes
+    """
+    def download(item):
+        image_reference_uuid, url, path = item
+        return item + (download_image(config, url, path, store=store, image_index=image_index,
+                                      image_reference_uuid=image_reference_uuid),)
 
-    multi = n_workers > 1
-    if multi:  # Use multiprocessing
-        pool = Pool(n_workers)
-        successes = pool.map(download_helper, url_path_tups)
-    else:  # Don't use multiprocessing
-        successes = map(download_helper, url_path_tups)
+    if n_workers <= 1:
+        yield from map(download, work)
+        return
 
-    # Zip the results into a dictionary
-    success_map = dict(zip(url_path_tups, successes))
+    # Keep a bounded number of downloads in flight so the work list is not materialized as futures
+    work = iter(work)
+    with ThreadPoolExecutor(n_workers) as executor:
+        pending = set(executor.submit(download, item) for item in islice(work, n_workers * QUEUE_FACTOR))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+            for item in islice(work, len(done)):
+                pending.add(executor.submit(download, item))
+
+
+def print_throughput(t0, n_done, n_total, n_bytes):
+    elapsed = max(time.time() - t0, 1e-6)
+    sys.stdout.write('{:>8}/{:<8} {:>8.1f} images/s {:>8.2f} MB/s\r'.format(
+        n_done, n_total, n_done / elapsed, n_bytes / elapsed / 1024 / 1024
+    ))
+    sys.stdout.flush()
+
+
+def download_images(image_reference_uuids, urls, paths, n_workers, config, journal=None, store=None, image_index=None,
+                    transcode_options=None, scale_index=None, n_transcode_workers=None):
+    """
+    Download the images specified by `urls` to `paths` using `n_workers` threads
+    If a journal is given, the outcome of each download is recorded in it as soon as it finishes
+    If a store is given, images are kept in (and linked from) the content-addressed store
+    If an image index is given, the metadata of each image is recorded in it as it is written
+    If transcode options are given, each image is resized/re-encoded to its path in a pool of `n_transcode_workers`
+    processes as soon as it is downloaded, and its scale factors are recorded in the scale index
+    """
+    n_total = len(urls)
+    pool = None
+    if transcode_options is not None:  # Download next to the final path, and record outcomes once transcoded
+        pool = TranscodePool(transcode_options, n_transcode_workers)
+        work = zip(image_reference_uuids, urls, map(source_path, paths, image_reference_uuids))
+        final_paths = dict(zip(image_reference_uuids, paths))
+        urls_by_uuid = dict(zip(image_reference_uuids, urls))
+    else:
+        work = zip(image_reference_uuids, urls, paths)
+
+    t0 = time.time()
+    total_bytes = 0
+    failures = []
+
+    def record(image_reference_uuid, url, path, ok):
+        if journal is not None:
+            journal.record(image_reference_uuid, STATE_DONE if ok else STATE_FAILED, path)
+        if not ok:
+            failures.append((url, path))
+
+    def record_transcodes(results):
+        for image_reference_uuid, path, result in results:
+            if result is not None:
+                scale_x, scale_y, info = result
+                if image_index is not None:
+                    image_index.add(image_reference_uuid, info)
+                scale_index.add(image_reference_uuid, path, scale_x, scale_y)
+            record(image_reference_uuid, urls_by_uuid[image_reference_uuid], path, result is not None)
+
+    downloads = iter_downloads(config, work, n_workers, store=store, image_index=image_index if pool is None else None)
+    for idx, (image_reference_uuid, url, path, n_bytes) in enumerate(downloads):
+        if n_bytes is not None:
+            total_bytes += n_bytes
+
+        if pool is None:
+            record(image_reference_uuid, url, path, n_bytes is not None)
+        elif n_bytes is None:
+            record(image_reference_uuid, url, final_paths[image_reference_uuid], False)
+        else:
+            pool.submit(image_reference_uuid, path, final_paths[image_reference_uuid])
+            record_transcodes(pool.completed())
+
+        print_throughput(t0, idx + 1, n_total, total_bytes)
+
+    print()
+    if pool is not None:
+        if len(pool):
+            print('Waiting for {} images to be transcoded...'.format(len(pool)))
+        record_transcodes(pool.finish())
 
-    # Extract failures and return
-    failures = [k for k, v in success_map.items() if not v]
     return failures
 
 
+def resolve_image_urls(config, image_reference_uuids, n_workers):
+    """
+    Look up the URLs of image references using `n_workers` concurrent requests
+    Returns a dict of image reference UUID -> URL for the image references that were found
+    """
+    image_reference_uuids = list(dict.fromkeys(image_reference_uuids))  # Dedupe, keeping order
+    n_total = len(image_reference_uuids)
+
+    def resolve(image_reference_uuid):
+        return image_reference_uuid, get_image_url(config, image_reference_uuid)
+
+    if n_workers > 1:
+        executor = ThreadPoolExecutor(n_workers)
+        results = executor.map(resolve, image_reference_uuids)
+    else:
+        executor = None
+        results = map(resolve, image_reference_uuids)
+
+    url_map = {}
+    for idx, (image_reference_uuid, url) in enumerate(results):
+        if url is not None:
+            url_map[image_reference_uuid] = url
+        sys.stdout.write('{:>8}/{:<8}\r'.format(idx + 1, n_total))
+        sys.stdout.flush()
+    print()
+
+    if executor is not None:
+        executor.shutdown()
+
+    return url_map
+
+
+def make_filename_map(url_map, output_dir, existing_map=None, transcode_options=None):
+    """
+    Map each image reference UUID to a path in `output_dir` named after its URL
+    Different images that share a URL basename get the image reference UUID appended so they don't overwrite each other
+    If an existing map is given, its images keep their paths and new images never take one of them
+    If transcode options are given, file names have the extension of the output format
+    """
+    basenames = {
+        iruuid: os.path.basename(url).replace(':', '_')  # Replace : with _ for Windows
+        for iruuid, url in url_map.items()
+    }
+    if transcode_options is not None:
+        basenames = {iruuid: transcode_options.path(basename) for iruuid, basename in basenames.items()}
+    basename_urls = {}
+    for iruuid, basename in basenames.items():
+        basename_urls.setdefault(basename, set()).add(url_map[iruuid])
+
+    existing_map = existing_map or {}
+    taken_paths = set(image_map_path(entry) for entry in existing_map.values())
+
+    filename_map = {}
+    for iruuid, basename in basenames.items():
+        if iruuid in existing_map:
+            filename_map[iruuid] = image_map_path(existing_map[iruuid])
+            continue
+
+        path = os.path.join(output_dir, basename)
+        if len(basename_urls[basename]) > 1 or path in taken_paths:  # Basename collision between different URLs
+            stem, ext = os.path.splitext(basename)
+            path = os.path.join(output_dir, '{}_{}{}'.format(stem, iruuid.lower(), ext))
+        filename_map[iruuid] = path
+
+    return filename_map
+
+
+def write_image_map(filename_map, existing_map=None, scale_index=None):
+    """ Write the image map, with the scale factors of transcoded images """
+    image_map = dict(existing_map or {})
+    for iruuid, path in filename_map.items():
+        image_map[iruuid] = image_map_entry(path, scale_index.get(iruuid, path) if scale_index is not None else None)
+
+    with metrics.timer('json.dump'), open(IMAGE_MAP_FILENAME, 'w') as f:
+        json.dump(image_map, f, indent=2, sort_keys=True)
+    print('Image map written to {}'.format(IMAGE_MAP_FILENAME))
+
+
 def get_image_url(config, image_reference_uuid):
     image_data = get_image_reference_data(config, image_reference_uuid)
-    if image_data is None:
+    if not image_data or 'url' not in image_data:  # Failed request or error response
         return None
 
     return image_data['url']
 
 
-def main(localizations_path, output_dir, n_workers, config_path, overwrite=False):
+def main(localizations_path, output_dir, n_workers, config_path, overwrite=False, resume=False,
+         store_dir=None, cache_dir=None, use_cache=True, update=False, transcode_options=None,
+         n_transcode_workers=None):
     # Load the config
     config = Config(config_path)
+    configure_cache(config, cache_dir=cache_dir, enabled=None if use_cache else False)
 
     # Load localizations
-    with open(localizations_path) as f:
+    with metrics.timer('json.load'), open(localizations_path) as f:
         localizations = json.load(f)
 
     # Extract all image reference UUIDs required by localizations
@@ -83,50 +348,87 @@ def main(localizations_path, output_dir, n_workers, config_path, overwrite=False
 
     # Get all needed URLs
     # If any missing, fetch from VARS
+    missing_uuids = sorted(image_reference_uuids.difference(available_url_map))
+    resolved_url_map = {}
+    if missing_uuids:
+        print('Fetching {} missing URLs...'.format(len(missing_uuids)))
+        with metrics.stage('resolve_urls'):
+            resolved_url_map = resolve_image_urls(config, missing_uuids, n_workers)
+        print('Resolved {}/{} missing URLs'.format(len(resolved_url_map), len(missing_uuids)))
+
     url_map = {}
     for image_reference_uuid in image_reference_uuids:
         if image_reference_uuid in available_url_map:
-            url = available_url_map[image_reference_uuid]
-        else:
-            print('Fetching missing URL for image reference UUID: {}'.format(image_reference_uuid))
-            url = get_image_url(config, image_reference_uuid)
-            if url is None:
-                continue
+            url_map[image_reference_uuid] = available_url_map[image_reference_uuid]
+        elif image_reference_uuid in resolved_url_map:
+            url_map[image_reference_uuid] = resolved_url_map[image_reference_uuid]
 
-        url_map[image_reference_uuid] = url
+    print_cache_stats(config)
 
     # Compute and write out a filename JSON map (for back-referencing)
-    filename_map = {
-        iruuid: os.path.join(output_dir, os.path.basename(url_map[iruuid]).replace(':', '_'))  # Replace : with _ for Windows
-        for iruuid in url_map
-    }
-    with open(IMAGE_MAP_FILENAME, 'w') as f:
-        json.dump(filename_map, f, indent=2, sort_keys=True)
-    print('Image map written to {}'.format(IMAGE_MAP_FILENAME))
+    existing_map = {}
+    if update and os.path.exists(IMAGE_MAP_FILENAME):  # Add to the map of a previous run
+        with metrics.timer('json.load'), open(IMAGE_MAP_FILENAME) as f:
+            existing_map = json.load(f)
+        print('Updating image map with {} images'.format(len(existing_map)))
+    filename_map = make_filename_map(url_map, output_dir, existing_map, transcode_options)
+    scale_index = ScaleIndex.for_directory(output_dir) if transcode_options is not None else None
+    write_image_map(filename_map, existing_map, scale_index)
 
-    # Extract URLs and file paths to parallel work lists
-    urls = [url_map[image_reference_uuid] for image_reference_uuid in url_map]
-    paths = [filename_map[image_reference_uuid] for image_reference_uuid in url_map]
+    # Extract image reference UUIDs, URLs and file paths to parallel work lists
+    iruuids = list(url_map)
+    urls = [url_map[image_reference_uuid] for image_reference_uuid in iruuids]
+    paths = [filename_map[image_reference_uuid] for image_reference_uuid in iruuids]
+
+    journal = DownloadJournal(output_dir)
+    image_index = ImageIndex.for_directory(output_dir)
 
     if not overwrite:  # Filter out already-downloaded images
-        url_path_tups = zip(urls, paths)
-        url_path_tups = list(filter(lambda t: not os.path.exists(t[1]), url_path_tups))
-        if not url_path_tups:
+        if scale_index is not None:  # Only images transcoded to their path count
+            def is_downloaded(iruuid, path):
+                return (journal.is_done(iruuid, path) if resume else os.path.exists(path)) and \
+                    scale_index.get(iruuid, path) is not None
+        elif resume:  # Trust the journal instead of checking the file system
+            is_downloaded = journal.is_done
+        else:
+            def is_downloaded(iruuid, path):
+                if not os.path.exists(path):
+                    return False
+                if iruuid not in image_index:  # Backfill images downloaded before they were indexed (header only)
+                    index_image(image_index, iruuid, path, checksum=False)
+                return True
+
+        with metrics.stage('check_existing'):
+            work = [t for t in zip(iruuids, urls, paths) if not is_downloaded(t[0], t[2])]
+        if not work:
+            image_index.close()
             print('All images already downloaded.')
             return
-        urls, paths = zip(*url_path_tups)
+        iruuids, urls, paths = zip(*work)
 
     confirm = input('Confirm download of {} images to {} (y/n): '.format(len(urls), os.path.abspath(output_dir)))
     if confirm.lower() == 'y':
         os.makedirs(output_dir, exist_ok=True)  # Create directories if they don't exist
         print('Downloading images (this could take a while)...')
-        failures = download_images(urls, paths, n_workers)
+        store = ImageStore(store_dir) if store_dir else None
+        with journal, image_index, metrics.stage('download'):
+            failures = download_images(iruuids, urls, paths, n_workers, config,
+                                       journal=journal, store=store, image_index=image_index,
+                                       transcode_options=transcode_options, scale_index=scale_index,
+                                       n_transcode_workers=n_transcode_workers)
+        if store is not None:
+            store.close()
+        if scale_index is not None:  # Add the scale factors of the transcoded images
+            scale_index.close()
+            write_image_map(filename_map, existing_map, scale_index)
         print('Download successful for {}/{} images.'.format(len(urls) - len(failures), len(urls)))
+        print_rate_control_stats(config)
         if failures:
             with open(DOWNLOAD_FAILURE_FILENAME, 'w') as f:
                 f.write('\n'.join([failure[0] + ',' + failure[1] for failure in failures]))
             print('{} failures written to {}'.format(len(failures), DOWNLOAD_FAILURE_FILENAME))
     else:
+        image_index.close()
         print('Canceled.')
 
 
@@ -140,12 +442,65 @@ if __name__ == '__main__':
                         help='Output directory')
     parser.add_argument('-j', '--jobs',
                         type=int,
-                        default=1,
-                        help='Number of multiprocessing jobs to use (default=1)')
+                        default=8,
+                        help='Number of download threads to use (default=8)')
     parser.add_argument('-c', '--config',
                         type=str,
                         default='config.ini',
                         help='Config path')
     parser.add_argument('-o', '--overwrite', action='store_true', help='Overwrite existing images')
+    parser.add_argument('-r', '--resume',
+                        action='store_true',
+                        help='Skip images recorded as downloaded in the output directory journal, without checking '
+                             'the files themselves')
+    parser.add_argument('-u', '--update',
+                        action='store_true',
+                        help='Add to the existing image map instead of replacing it, e.g. when downloading the images '
+                             'of a delta digest (see generate_digest.py --update)')
+    parser.add_argument('-s', '--store',
+                        type=str,
+                        default=None,
+                        help='(optional) Content-addressed image store directory. Images are downloaded once into the '
+                             'store and linked into the output directory')
+    parser.add_argument('--max_side',
+                        type=int,
+                        default=None,
+                        help='(optional) Shrink images so their longest side is at most this many pixels')
+    parser.add_argument('--image_format',
+                        type=str.upper,
+                        choices=list(TRANSCODE_FORMATS),
+                        default=None,
+                        help='(optional) Re-encode images to this format')
+    parser.add_argument('--quality',
+                        type=int,
+                        default=DEFAULT_QUALITY,
+                        help='JPEG/WebP quality for resized or re-encoded images (default={})'.format(DEFAULT_QUALITY))
+    parser.add_argument('--transcode_jobs',
+                        type=int,
+                        default=None,
+                        help='Number of processes for resizing/re-encoding images (default=number of CPUs)')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        default=None,
+                        help='M3 response cache directory (overrides the [cache] config section)')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='Disable the M3 response cache')
+    parser.add_argument('--profile',
+                        type=str,
+                        default=None,
+                        help='(optional) Write per-stage wall time and HTTP/image I/O timings to a JSON report')
+    parser.add_argument('--cprofile',
+                        type=str,
+                        default=None,
+                        help='(optional) Write cProfile stats to a file')
     args = parser.parse_args()
-    main(args.localizations, args.output_dir, args.jobs, args.config, overwrite=args.overwrite)
+
+    transcode = None
+    if args.max_side is not None or args.image_format is not None:
+        transcode = TranscodeOptions(max_side=args.max_side, format=args.image_format, quality=args.quality)
+
+    with metrics.profile(args.profile, args.cprofile):
+        main(args.localizations, args.output_dir, args.jobs, args.config, overwrite=args.overwrite, resume=args.resume,
+             store_dir=args.store, cache_dir=args.cache_dir, use_cache=not args.no_cache, update=args.update,
+             transcode_options=transcode, n_transcode_workers=args.transcode_jobs)
@@ -6,6 +6,9 @@ Extract localizations from a digest (see generate_digest.py) and format them nic
 import argparse
 import json
 
+from lib import metrics
+from lib.jsonstream import iter_json_file, JSONArrayWriter
+
 
 def observation_localizations(observation_data):
     for assoc in observation_data['associations']:
@@ -19,33 +22,44 @@ def observation_localizations(observation_data):
             }
 
 
-def extract_localizations(observations):
-    localizations = []
+def iter_localizations(observations):
+    """ Yield the localizations of each observation in an iterable of observations """
     for observation in observations:
-        localizations.extend(list(observation_localizations(observation)))
-    return localizations
+        yield from observation_localizations(observation)
 
 
-def main(digest_paths):
-    all_localizations = []
-    for digest_path in digest_paths:
-        with open(digest_path) as f:
-            observations = json.load(f)
-            localizations = extract_localizations(observations)
-            print('{:<50}: {:>10} localizations'.format(digest_path, len(localizations)))
-            all_localizations.extend(localizations)
+def extract_localizations(observations):
+    return list(iter_localizations(observations))
 
-    print('Extracted {} total localizations'.format(len(all_localizations)))
 
-    out_path = 'localizations.json'
-    with open(out_path, 'w') as f:
-        json.dump(all_localizations, f, indent=2)
+def main(digest_paths, out_path='localizations.json'):
+    # Stream observations from each digest and localizations to the output, so memory use does not grow with input size
+    with open(out_path, 'w') as out_f, JSONArrayWriter(out_f) as writer:
+        for digest_path in digest_paths:
+            n_before = writer.count
+            with metrics.stage('extract ' + digest_path):
+                writer.extend(iter_localizations(iter_json_file(digest_path)))
+            print('{:<50}: {:>10} localizations'.format(digest_path, writer.count - n_before))
 
+    print('Extracted {} total localizations'.format(writer.count))
     print('Wrote to {}'.format(out_path))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('digest', nargs='+', type=str, help='Path to the digest JSON')
+    parser.add_argument('digest', nargs='+', type=str, help='Path to the digest JSON (.json) or JSON Lines (.jsonl)')
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        default='localizations.json',
+                        help='Output localizations JSON path (default=localizations.json)')
+    parser.add_argument('--profile',
+                        type=str,
+                        default=None,
+                        help='(optional) Write per-stage wall time and JSON timings to a JSON report')
+    parser.add_argument('--cprofile',
+                        type=str,
+                        default=None,
+                        help='(optional) Write cProfile stats to a file')
     args = parser.parse_args()
-    main(args.digest)
+    with metrics.profile(args.profile, args.cprofile):
+        main(args.digest, args.output)
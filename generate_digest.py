@@ -6,103 +6,433 @@ Look up observations (with a valid image) for a given concept and generate a dig
 import argparse
 import datetime
 import json
+import os
 import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from lib import metrics
+from lib.cache import configure_cache, print_cache_stats
 from lib.config import Config
+from lib.jsonstream import iter_json_file, iter_jsonl, JSONArrayWriter, repair_jsonl
 from lib.m3_requests import get_fast_concept_images, get_concept_descendants, get_imaged_moment_data
+from lib.ratecontrol import print_rate_control_stats
 
 WHITESPACE_REPLACEMENT = '_'
+WINDOW_FACTOR = 4  # In-flight imaged moment requests per worker
+PROGRESS_SUFFIX = '.progress'
+PARTIAL_SUFFIX = '.part'
+CHANGES_SUFFIX = '_changes.jsonl'
+DELTA_SUFFIX = '_delta'
+
+CHANGE_ADDED = 'added'
+CHANGE_CHANGED = 'changed'
+CHANGE_REMOVED = 'removed'
+
+
+def digest_path(concept, include_descendants, digest_format='json'):
+    return concept.replace(' ', WHITESPACE_REPLACEMENT) + ('_desc' if include_descendants else '') + '_digest.' + digest_format
+
+
+class JSONLDigest:
+    """
+    JSON Lines digest, appended to as observations are fetched
+    An interrupted digest can be resumed: observations already written are skipped, and imaged moments already
+    expanded (with --all) are tracked in a progress file next to the digest until the run completes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.progress_path = path + PROGRESS_SUFFIX
+        self.observation_uuids = set()
+        self.expanded_imaged_moment_uuids = set()
+
+        if os.path.exists(self.path):
+            repair_jsonl(self.path)
+            with open(self.path) as f:
+                self.observation_uuids.update(obs['observation_uuid'] for obs in iter_jsonl(f))
+
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path) as f:
+                self.expanded_imaged_moment_uuids.update(line.strip() for line in f if line.endswith('\n'))
+
+        self._f = open(self.path, 'a')
+        self._progress_f = None
+
+    def write(self, observations):
+        """ Append observations that are not already in the digest """
+        for obs in observations:
+            if obs['observation_uuid'] in self.observation_uuids:
+                continue
+            self.observation_uuids.add(obs['observation_uuid'])
+            with metrics.timer('json.encode'):
+                self._f.write(json.dumps(obs) + '\n')
+        self._f.flush()
+
+    def mark_expanded(self, imaged_moment_uuid):
+        if self._progress_f is None:
+            self._progress_f = open(self.progress_path, 'a')
+        self._progress_f.write(imaged_moment_uuid + '\n')
+        self._progress_f.flush()
+        self.expanded_imaged_moment_uuids.add(imaged_moment_uuid)
+
+    def close(self, complete=False):
+        self._f.close()
+        if self._progress_f is not None:
+            self._progress_f.close()
+        if complete and os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
 
 
 def write_digest(json_data, concept, include_descendants):
-    out_path = concept.replace(' ', WHITESPACE_REPLACEMENT) + ('_desc' if include_descendants else '') + '_digest.json'
-    with open(out_path, 'w') as f:
+    out_path = digest_path(concept, include_descendants)
+    with metrics.timer('json.dump'), open(out_path, 'w') as f:
         json.dump(json_data, f, indent=2)
     print('Wrote digest to {}'.format(out_path))
 
 
-def main(concept, config_path, include_descendants, include_all):
+def imaged_moment_observations(imaged_moment_uuid, imaged_moment):
+    """ Construct JSON blobs following the fast endpoint response schema for each observation in an imaged moment """
+    for observation in imaged_moment['observations']:
+        obs_data = {
+            'observation_uuid': observation['uuid'],
+            'concept': observation['concept'],
+            'observer': observation['observer'],
+            'video_reference_uuid': imaged_moment['video_reference_uuid'],
+            'imaged_moment_uuid': imaged_moment_uuid,
+            'associations': observation['associations'],
+            'image_references': imaged_moment['image_references']
+        }
+
+        # Find time key(s) and tack on
+        if 'recorded_date' in imaged_moment:
+            obs_data['recorded_timestamp'] = imaged_moment['recorded_date']  # Inconsistency in M3
+        if 'timecode' in imaged_moment:
+            obs_data['timecode'] = imaged_moment['timecode']
+        if 'elapsed_time_millis' in imaged_moment:
+            obs_data['elapsed_time_millis'] = imaged_moment['elapsed_time_millis']
+
+        # Some more misc keys
+        if 'activity' in observation:
+            obs_data['activity'] = observation['activity']
+
+        yield obs_data
+
+
+def fetch_concept_observations(config, concepts, concurrency=1):
+    """
+    Fetch the observations of each concept using up to `concurrency` concurrent requests
+    Yields (concept, observations or None on failure, seconds taken) in the same order as `concepts`
+    """
+    def fetch(c):
+        t0 = time.time()
+        json_part = get_fast_concept_images(config, c)
+        return c, json_part, time.time() - t0
+
+    if concurrency <= 1:
+        yield from map(fetch, concepts)
+        return
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        yield from executor.map(fetch, concepts)
+
+
+def print_progress(t0, n_done, n_total):
+    rate = (time.time() - t0) / n_done
+    seconds_remaining = round(rate * (n_total - n_done))
+    output_str = 'Remaining time: {:<10} {:>20}\r'.format(
+        str(datetime.timedelta(seconds=seconds_remaining)),
+        '({}/{})'.format(n_done, n_total)
+    )
+    sys.stdout.write(output_str)
+    sys.stdout.flush()
+
+
+def fetch_imaged_moments(config, imaged_moment_uuids, concurrency, refresh=False):
+    """
+    Fetch imaged moment data for each UUID using up to `concurrency` concurrent requests
+    Yields (imaged moment UUID, data) pairs in the same order as `imaged_moment_uuids`
+    If `refresh` is set, cached imaged moments are refetched
+    """
+    if concurrency <= 1:
+        for imaged_moment_uuid in imaged_moment_uuids:
+            yield imaged_moment_uuid, get_imaged_moment_data(config, imaged_moment_uuid, refresh)
+        return
+
+    # Keep a bounded window of in-flight requests so results can be yielded in order without queueing everything
+    window = deque()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for imaged_moment_uuid in imaged_moment_uuids:
+            future = executor.submit(get_imaged_moment_data, config, imaged_moment_uuid, refresh)
+            window.append((imaged_moment_uuid, future))
+            if len(window) >= concurrency * WINDOW_FACTOR:
+                uuid, future = window.popleft()
+                yield uuid, future.result()
+
+        while window:
+            uuid, future = window.popleft()
+            yield uuid, future.result()
+
+
+def iter_imaged_moment_additions(config, imaged_moment_uuids, observation_uuids, concurrency=1, progress=True):
+    """
+    Yield (imaged moment UUID, new observations) for each imaged moment, in order
+    New observations are those whose UUIDs are not in `observation_uuids`, which is updated in place
+    Progress is printed unless `progress` is False (e.g. when another stage prints its own)
+    """
+    imaged_moment_uuids = list(imaged_moment_uuids)
+    n_uuids = len(imaged_moment_uuids)
+
+    t0 = time.time()
+
+    imaged_moments = fetch_imaged_moments(config, imaged_moment_uuids, concurrency)
+    for idx, (imaged_moment_uuid, imaged_moment) in enumerate(imaged_moments):
+        if progress:
+            print_progress(t0, idx + 1, n_uuids)
+
+        if not imaged_moment:
+            continue
+
+        # Add new observations
+        added_observations = []
+        for obs_data in imaged_moment_observations(imaged_moment_uuid, imaged_moment):
+            if obs_data['observation_uuid'] not in observation_uuids:  # Ensures no duplicates
+                observation_uuids.add(obs_data['observation_uuid'])
+                added_observations.append(obs_data)
+
+        yield imaged_moment_uuid, added_observations
+
+
+def expand_imaged_moments(config, imaged_moment_uuids, observation_uuids, concurrency=1):
+    """
+    Get all observations in the given imaged moments whose UUIDs are not in `observation_uuids`
+    `observation_uuids` is updated in place with the UUIDs of the added observations
+    """
+    added_observations = []
+    for _, added in iter_imaged_moment_additions(config, imaged_moment_uuids, observation_uuids, concurrency):
+        added_observations.extend(added)
+
+    return added_observations
+
+
+def write_observations(path, observations):
+    """ Atomically write observations as a JSON array (.json) or JSON Lines (.jsonl) """
+    temp_path = path + PARTIAL_SUFFIX
+    with metrics.timer('json.dump'), open(temp_path, 'w') as f:
+        if path.endswith('.jsonl'):
+            for obs in observations:
+                f.write(json.dumps(obs) + '\n')
+        else:
+            with JSONArrayWriter(f) as writer:
+                writer.extend(observations)
+    os.replace(temp_path, path)
+
+
+def change_record(change, obs, fields=None):
+    record = {
+        'change': change,
+        'observation_uuid': obs['observation_uuid'],
+        'imaged_moment_uuid': obs['imaged_moment_uuid'],
+        'concept': obs['concept']
+    }
+    if fields is not None:
+        record['fields'] = fields
+    return record
+
+
+def merge_observations(existing, fetched, kept_imaged_moment_uuids=frozenset()):
+    """
+    Merge freshly fetched observations into an existing digest (ordered dict of observation UUID -> observation)
+    Existing observations that were not fetched again are removed, unless their imaged moment is in
+    `kept_imaged_moment_uuids` (not refetched)
+    Returns the merged observations (in their existing order, then new ones) and the list of changes
+    """
+    fetched = {obs['observation_uuid']: obs for obs in fetched}
+    merged = []
+    changes = []
+    for observation_uuid, old in existing.items():
+        new = fetched.pop(observation_uuid, None)
+        if new is None:
+            if old['imaged_moment_uuid'] in kept_imaged_moment_uuids:
+                merged.append(old)
+            else:
+                changes.append(change_record(CHANGE_REMOVED, old))
+        elif new != old:
+            merged.append(new)
+            fields = sorted(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+            changes.append(change_record(CHANGE_CHANGED, new, fields))
+        else:
+            merged.append(old)
+
+    for new in fetched.values():
+        merged.append(new)
+        changes.append(change_record(CHANGE_ADDED, new))
+
+    return merged, changes
+
+
+def update_digest(config, concept, existing_path, include_descendants, include_all, concurrency=1,
+                  digest_format='json'):
+    """
+    Refresh an existing digest: refetch the concept observations, compare them to the digest by observation UUID, and
+    (with `include_all`) only refetch the imaged moments of new or changed observations
+    Writes the merged digest, a change log and a delta digest of the new and changed observations
+    """
+    with metrics.stage('load'):
+        existing = {obs['observation_uuid']: obs for obs in iter_json_file(existing_path)}
+    print('Loaded {} observations from {}'.format(len(existing), existing_path))
+
+    concepts = [concept]
+    if include_descendants:
+        with metrics.stage('descendants'):
+            concepts += list(get_concept_descendants(config, concept))
+        print('Included concepts: {}'.format(', '.join(concepts)))
+
+    # The concept observation lists can't be filtered by modification time, so they are refetched and compared
+    fetched = {}
+    with metrics.stage('observations'):
+        for c, json_part, seconds in fetch_concept_observations(config, concepts, concurrency):
+            if json_part is None:  # Fatal: its observations would all look removed
+                print('[ERROR] Failed to get observations for {}, digest not updated'.format(c))
+                exit(1)
+            print('{:<50}: {:>10} observations ({:.2f} s)'.format(c, len(json_part), seconds))
+            for obs in json_part:
+                fetched.setdefault(obs['observation_uuid'], obs)
+
+    kept_imaged_moment_uuids = set()
+    if include_all:
+        # Imaged moments of unchanged observations keep their other observations from the existing digest
+        refreshed = {}  # Ordered set
+        for observation_uuid, obs in fetched.items():
+            if existing.get(observation_uuid) != obs:
+                refreshed[obs['imaged_moment_uuid']] = None
+            else:
+                kept_imaged_moment_uuids.add(obs['imaged_moment_uuid'])
+        kept_imaged_moment_uuids.difference_update(refreshed)
+        print('Fetching all other observations for {} new or changed imaged moments...'.format(len(refreshed)))
+
+        t0 = time.time()
+        with metrics.stage('imaged_moments'):
+            imaged_moments = fetch_imaged_moments(config, refreshed, concurrency, refresh=True)
+            for idx, (imaged_moment_uuid, imaged_moment) in enumerate(imaged_moments):
+                print_progress(t0, idx + 1, len(refreshed))
+                if not imaged_moment:  # Keep what we have
+                    kept_imaged_moment_uuids.add(imaged_moment_uuid)
+                    continue
+                for obs in imaged_moment_observations(imaged_moment_uuid, imaged_moment):
+                    fetched.setdefault(obs['observation_uuid'], obs)
+        print()
+
+    merged, changes = merge_observations(existing, fetched.values(), kept_imaged_moment_uuids)
+    counts = {change: 0 for change in (CHANGE_ADDED, CHANGE_CHANGED, CHANGE_REMOVED)}
+    for record in changes:
+        counts[record['change']] += 1
+    print('{} added, {} changed, {} removed, {} unchanged observations'.format(
+        counts[CHANGE_ADDED], counts[CHANGE_CHANGED], counts[CHANGE_REMOVED],
+        len(merged) - counts[CHANGE_ADDED] - counts[CHANGE_CHANGED]
+    ))
+
+    out_path = digest_path(concept, include_descendants, digest_format)
+    stem = os.path.splitext(out_path)[0]
+    changes_path = stem + CHANGES_SUFFIX
+    delta_path = stem + DELTA_SUFFIX + '.' + digest_format
+    delta_uuids = set(record['observation_uuid'] for record in changes if record['change'] != CHANGE_REMOVED)
+
+    with metrics.stage('write'):
+        write_observations(out_path, merged)
+        write_observations(delta_path, (obs for obs in merged if obs['observation_uuid'] in delta_uuids))
+        write_observations(changes_path, changes)
+    print('Wrote digest to {}'.format(out_path))
+    print('Wrote {} new and changed observations to {}'.format(len(delta_uuids), delta_path))
+    print('Wrote change log to {}'.format(changes_path))
+
+
+def main(concept, config_path, include_descendants, include_all, concurrency=1, cache_dir=None, use_cache=True,
+         digest_format='json', update_path=None):
     config = Config(config_path)
+    configure_cache(config, cache_dir=cache_dir, enabled=None if use_cache else False)
+
+    if update_path is not None:
+        if not os.path.exists(update_path):
+            print('[ERROR] Digest to update not found: {}'.format(update_path))
+            exit(1)
+        update_digest(config, concept, update_path, include_descendants, include_all, concurrency=concurrency,
+                      digest_format=digest_format)
+        print_cache_stats(config)
+        print_rate_control_stats(config)
+        return
+
+    jsonl_digest = None
+    if digest_format == 'jsonl':  # Append to the digest as observations are fetched
+        jsonl_digest = JSONLDigest(digest_path(concept, include_descendants, digest_format))
+        if jsonl_digest.observation_uuids:
+            print('Resuming digest {} with {} observations'.format(jsonl_digest.path, len(jsonl_digest.observation_uuids)))
+
     if include_descendants:
         print('Getting observations for {} + descendants...'.format(concept))
-        concepts = list(get_concept_descendants(config, concept))
+        with metrics.stage('descendants'):
+            concepts = list(get_concept_descendants(config, concept))
         concepts.insert(0, concept)
         print('Included concepts: {}'.format(', '.join(concepts)))
         json_data = []
-        for c in concepts:
-            json_part = get_fast_concept_images(config, c)
-            if json_part is None:  # Fatal
+        failed_concepts = []
+        with metrics.stage('observations'):
+            for c, json_part, seconds in fetch_concept_observations(config, concepts, concurrency):
+                if json_part is None:
+                    failed_concepts.append(c)
+                    print('{:<50}: {:>10} ({:.2f} s)'.format(c, 'FAILED', seconds))
+                    continue
+                print('{:<50}: {:>10} observations ({:.2f} s)'.format(c, len(json_part), seconds))
+                json_data.extend(json_part)
+                if jsonl_digest is not None:
+                    jsonl_digest.write(json_part)
+        if failed_concepts:
+            print('[ERROR] Failed to get observations for {}/{} concepts: {}'.format(
+                len(failed_concepts), len(concepts), ', '.join(failed_concepts)
+            ))
+            if len(failed_concepts) == len(concepts):  # Fatal
                 exit(1)
-            json_data.extend(json_part)
         print('Found {} observations of {} + descendants with valid images'.format(len(json_data), concept))
     else:
         print('Getting observations for {}...'.format(concept))
-        json_data = get_fast_concept_images(config, concept)
-        if not json_data:  # Fatal
-            exit(1)
+        with metrics.stage('observations'):
+            json_data = get_fast_concept_images(config, concept)
+            if not json_data:  # Fatal
+                exit(1)
+            if jsonl_digest is not None:
+                jsonl_digest.write(json_data)
         print('Found {} observations of {} with valid images'.format(len(json_data), concept))
 
     if include_all:
         imaged_moment_uuids = set(obs['imaged_moment_uuid'] for obs in json_data)
-        n_uuids = len(imaged_moment_uuids)
-        print('Fetching all other observations for {} imaged moments...'.format(n_uuids))
-
-        t0 = time.time()
-
-        added_observations = []
         observation_uuids = set(obs['observation_uuid'] for obs in json_data)
-        for idx, imaged_moment_uuid in enumerate(imaged_moment_uuids):
-            if idx % 1 == 0:
-                rate = (time.time() - t0) / (idx + 1 / n_uuids)
-                seconds_remaining = round(rate * (n_uuids - (idx + 1)))
-                output_str = 'Remaining time: {:<10} {:>20}\r'.format(
-                    str(datetime.timedelta(seconds=seconds_remaining)),
-                    '({}/{})'.format(idx + 1, n_uuids)
-                )
-                sys.stdout.write(output_str)
-                sys.stdout.flush()
-
-            # Grab the imaged moment data
-            imaged_moment = get_imaged_moment_data(config, imaged_moment_uuid)
-            if not imaged_moment:
-                continue
-
-            # Add new observations
-            for observation in imaged_moment['observations']:
-                observation_uuid = observation['uuid']
-                if observation_uuid not in observation_uuids:  # Ensures no duplicates
-                    observation_uuids.add(observation_uuid)
+        if jsonl_digest is not None:  # Skip imaged moments already expanded by an interrupted run
+            imaged_moment_uuids -= jsonl_digest.expanded_imaged_moment_uuids
+            observation_uuids |= jsonl_digest.observation_uuids
+        print('Fetching all other observations for {} imaged moments...'.format(len(imaged_moment_uuids)))
 
-                    # Construct a JSON blob following the fast endpoint response schema
-                    obs_data = {
-                        'observation_uuid': observation_uuid,
-                        'concept': observation['concept'],
-                        'observer': observation['observer'],
-                        'video_reference_uuid': imaged_moment['video_reference_uuid'],
-                        'imaged_moment_uuid': imaged_moment_uuid,
-                        'associations': observation['associations'],
-                        'image_references': imaged_moment['image_references']
-                    }
+        n_added = 0
+        with metrics.stage('imaged_moments'):
+            additions = iter_imaged_moment_additions(config, imaged_moment_uuids, observation_uuids, concurrency)
+            for imaged_moment_uuid, added in additions:
+                if jsonl_digest is not None:  # Written as we go, no need to hold on to them
+                    jsonl_digest.write(added)
+                    jsonl_digest.mark_expanded(imaged_moment_uuid)
+                else:
+                    json_data += added
+                n_added += len(added)
 
-                    # Find time key(s) and tack on
-                    if 'recorded_date' in imaged_moment:
-                        obs_data['recorded_timestamp'] = imaged_moment['recorded_date']  # Inconsistency in M3
-                    if 'timecode' in imaged_moment:
-                        obs_data['timecode'] = imaged_moment['timecode']
-                    if 'elapsed_time_millis' in imaged_moment:
-                        obs_data['elapsed_time_millis'] = imaged_moment['elapsed_time_millis']
+        print('\nAdded {} observations'.format(n_added))
 
-                    # Some more misc keys
-                    if 'activity' in observation:
-                        obs_data['activity'] = observation['activity']
-
-                    added_observations.append(obs_data)
-
-        json_data += added_observations
-        print('\nAdded {} observations'.format(len(added_observations)))
-
-    write_digest(json_data, concept, include_descendants)
+    if jsonl_digest is not None:
+        jsonl_digest.close(complete=True)
+        print('Wrote digest to {}'.format(jsonl_digest.path))
+    else:
+        with metrics.stage('write'):
+            write_digest(json_data, concept, include_descendants)
+    print_cache_stats(config)
+    print_rate_control_stats(config)
 
 
 if __name__ == '__main__':
@@ -120,5 +450,40 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--all',
                         action='store_true',
                         help='Flag to include all other observations for each imaged moment in digest')
+    parser.add_argument('-n', '--concurrency',
+                        type=int,
+                        default=8,
+                        help='Number of concurrent M3 requests for descendant concepts (--descendants) and imaged '
+                             'moments (--all) (default=8)')
+    parser.add_argument('-f', '--format',
+                        type=str,
+                        choices=['json', 'jsonl'],
+                        default='json',
+                        help='Digest format. A JSON Lines (jsonl) digest is appended to while fetching, and an '
+                             'interrupted run resumes from the observations already written (default=json)')
+    parser.add_argument('-u', '--update', '--since',
+                        type=str,
+                        default=None,
+                        dest='update',
+                        help='(optional) Existing digest to update. Only new or changed observations (and, with --all, '
+                             'their imaged moments) are fetched in full; the merged digest, a change log and a delta '
+                             'digest are written')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        default=None,
+                        help='M3 response cache directory (overrides the [cache] config section)')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='Disable the M3 response cache')
+    parser.add_argument('--profile',
+                        type=str,
+                        default=None,
+                        help='(optional) Write per-stage wall time and HTTP/JSON timings to a JSON report')
+    parser.add_argument('--cprofile',
+                        type=str,
+                        default=None,
+                        help='(optional) Write cProfile stats to a file')
     args = parser.parse_args()
-    main(args.concept, args.config, args.descendants, args.all)
+    with metrics.profile(args.profile, args.cprofile):
+        main(args.concept, args.config, args.descendants, args.all, concurrency=args.concurrency,
+             cache_dir=args.cache_dir, use_cache=not args.no_cache, digest_format=args.format, update_path=args.update)
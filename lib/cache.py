@@ -0,0 +1,186 @@
+# cache.py (m3-download)
+"""
+Persistent SQLite-backed cache for M3 responses
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Optional
+
+from lib.config import Config
+
+CACHE_FILENAME = 'm3_cache.sqlite'
+
+# Defaults used when the config has no [cache] section
+DEFAULT_CACHE_DIR = '.m3_cache'
+DEFAULT_TTL_DAYS = 30
+DEFAULT_MAX_SIZE_MB = 1024
+
+EVICTION_TARGET = 0.9  # Fraction of the max size to evict down to
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class ResponseCache:
+    """ Cache of decoded JSON responses keyed by (endpoint, key), with TTL and LRU size-based eviction """
+
+    def __init__(self, path: str, ttl: float, max_size: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'endpoint TEXT NOT NULL, '
+            'key TEXT NOT NULL, '
+            'value BLOB NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'created REAL NOT NULL, '
+            'accessed REAL NOT NULL, '
+            'PRIMARY KEY (endpoint, key))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._conn.commit()
+
+        self._size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, endpoint: str, key: str):
+        """ Get a cached response, or None if it is missing or expired """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, created FROM responses WHERE endpoint = ? AND key = ?', (endpoint, key)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            value, created = row
+            if self.ttl and now - created > self.ttl:
+                self._delete(endpoint, key)
+                self._conn.commit()
+                self.expired += 1
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                'UPDATE responses SET accessed = ? WHERE endpoint = ? AND key = ?', (now, endpoint, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+
+        return json.loads(zlib.decompress(value))
+
+    def put(self, endpoint: str, key: str, data):
+        """ Store a response, evicting the least recently used entries if the cache grows too large """
+        value = zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._delete(endpoint, key)
+            self._conn.execute(
+                'INSERT INTO responses (endpoint, key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)',
+                (endpoint, key, value, len(value), now, now)
+            )
+            self._size += len(value)
+
+            if self.max_size and self._size > self.max_size:
+                self._evict(int(self.max_size * EVICTION_TARGET))
+
+            self._conn.commit()
+
+    def _delete(self, endpoint: str, key: str):
+        row = self._conn.execute(
+            'SELECT size FROM responses WHERE endpoint = ? AND key = ?', (endpoint, key)
+        ).fetchone()
+        if row is not None:
+            self._conn.execute('DELETE FROM responses WHERE endpoint = ? AND key = ?', (endpoint, key))
+            self._size -= row[0]
+
+    def _evict(self, target_size: int):
+        rows = self._conn.execute('SELECT endpoint, key, size FROM responses ORDER BY accessed')
+        to_delete = []
+        for endpoint, key, size in rows:
+            if self._size <= target_size:
+                break
+            to_delete.append((endpoint, key))
+            self._size -= size
+
+        self._conn.executemany('DELETE FROM responses WHERE endpoint = ? AND key = ?', to_delete)
+        self.evictions += len(to_delete)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'size_bytes': self._size
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def configure_cache(config: Config, cache_dir: Optional[str] = None, enabled: Optional[bool] = None):
+    """
+    Override the [cache] config section (e.g. from --cache-dir/--no-cache command line arguments)
+    Settings left as None keep their config values
+    """
+    if not config.parser.has_section('cache'):
+        config.parser.add_section('cache')
+    if enabled is not None:
+        config.parser.set('cache', 'enabled', str(enabled))
+    if cache_dir is not None:
+        config.parser.set('cache', 'dir', cache_dir)
+
+
+def get_cache(config: Config) -> Optional[ResponseCache]:
+    """ Get the shared response cache for a config, or None if caching is disabled """
+    if not config.parser.getboolean('cache', 'enabled', fallback=True):
+        return None
+
+    key = (config.path, os.getpid())
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache_dir = config.parser.get('cache', 'dir', fallback=DEFAULT_CACHE_DIR)
+            os.makedirs(cache_dir, exist_ok=True)
+            cache = ResponseCache(
+                os.path.join(cache_dir, CACHE_FILENAME),
+                ttl=config.getfloat('cache', 'ttl_days', fallback=DEFAULT_TTL_DAYS) * 24 * 60 * 60,
+                max_size=int(config.getfloat('cache', 'max_size_mb', fallback=DEFAULT_MAX_SIZE_MB) * 1024 * 1024)
+            )
+            _caches[key] = cache
+        return cache
+
+
+def print_cache_stats(config: Config):
+    """ Print hit/miss statistics for the shared response cache of this process, if any """
+    cache = _caches.get((config.path, os.getpid()))
+    if cache is None:
+        return
+
+    stats = cache.stats
+    n_lookups = stats['hits'] + stats['misses']
+    print('[INFO] Cache: {} hits, {} misses ({:.1f}% hit rate), {} expired, {} evicted, {:.1f} MB on disk'.format(
+        stats['hits'], stats['misses'],
+        100 * stats['hits'] / n_lookups if n_lookups else 0,
+        stats['expired'], stats['evictions'],
+        stats['size_bytes'] / 1024 / 1024
+    ))
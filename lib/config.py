@@ -12,3 +12,12 @@ class Config:
     def __call__(self, *args, **kwargs):
         assert len(args) == 2
         return self.parser.get(args[0], args[1])
+
+    def getint(self, section: str, option: str, fallback: int = None) -> int:
+        return self.parser.getint(section, option, fallback=fallback)
+
+    def getfloat(self, section: str, option: str, fallback: float = None) -> float:
+        return self.parser.getfloat(section, option, fallback=fallback)
+
+    def getboolean(self, section: str, option: str, fallback: bool = None) -> bool:
+        return self.parser.getboolean(section, option, fallback=fallback)
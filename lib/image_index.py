@@ -0,0 +1,119 @@
+# image_index.py (m3-download)
+"""
+Sidecar index of downloaded image metadata (size, mode, byte length, checksum)
+"""
+import hashlib
+import os
+import threading
+from typing import NamedTuple, Optional
+
+from PIL import Image
+
+from lib import metrics
+
+INDEX_FILENAME = 'image_index.tsv'
+NO_CHECKSUM = '-'
+HASH_CHUNK_SIZE = 1 << 20
+
+
+class ImageInfo(NamedTuple):
+    width: int
+    height: int
+    mode: str
+    bands: int
+    n_bytes: int
+    sha256: str = NO_CHECKSUM
+
+
+def probe_image(path: str, n_bytes: Optional[int] = None, sha256: Optional[str] = None,
+                checksum: bool = True) -> ImageInfo:
+    """
+    Get the metadata of an image file by reading only its header
+    The byte length and SHA-256 checksum are computed from the file unless given (and `checksum` is set)
+    """
+    with metrics.timer('image.probe'), Image.open(path) as im:  # Lazy: decodes the header, not the pixel data
+        width, height = im.size
+        mode = im.mode
+        bands = len(im.getbands())
+
+    if n_bytes is None:
+        n_bytes = os.path.getsize(path)
+
+    if sha256 is None:
+        if checksum:
+            hasher = hashlib.sha256()
+            with metrics.timer('image.hash'), open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+            sha256 = hasher.hexdigest()
+        else:
+            sha256 = NO_CHECKSUM
+
+    return ImageInfo(width, height, mode, bands, n_bytes, sha256)
+
+
+class ImageIndex:
+    """ Append-only, tab-separated index of image metadata keyed by image reference UUID. The last line for a UUID wins """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+
+        self._lock = threading.Lock()
+        self._file = None
+
+        self.load()
+
+    @classmethod
+    def for_directory(cls, output_dir: str) -> 'ImageIndex':
+        return cls(os.path.join(output_dir, INDEX_FILENAME))
+
+    def load(self):
+        self.entries.clear()
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) != 7:  # Partially written line from a killed run
+                    continue
+                image_reference_uuid, width, height, mode, bands, n_bytes, sha256 = parts
+                self.entries[image_reference_uuid] = ImageInfo(
+                    int(width), int(height), mode, int(bands), int(n_bytes), sha256
+                )
+
+    def __contains__(self, image_reference_uuid: str) -> bool:
+        return image_reference_uuid in self.entries
+
+    def get(self, image_reference_uuid: str) -> Optional[ImageInfo]:
+        return self.entries.get(image_reference_uuid)
+
+    def add(self, image_reference_uuid: str, info: ImageInfo):
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._file = open(self.path, 'a')
+            self._file.write('\t'.join(map(str, (image_reference_uuid,) + tuple(info))) + '\n')
+            self._file.flush()
+            self.entries[image_reference_uuid] = info
+
+    def get_or_probe(self, image_reference_uuid: str, path: str) -> Optional[ImageInfo]:
+        """ Get the metadata for an image, backfilling it with a header-only probe if it is not indexed yet """
+        info = self.entries.get(image_reference_uuid)
+        if info is None and os.path.exists(path):
+            info = probe_image(path, checksum=False)
+            self.add(image_reference_uuid, info)
+        return info
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,65 @@
+# journal.py (m3-download)
+"""
+Append-only journal of image download state, kept per output directory
+"""
+import os
+from typing import Optional
+
+JOURNAL_FILENAME = '.download_journal.tsv'
+
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+
+class DownloadJournal:
+    """
+    Records the download state of each image reference UUID as tab-separated (state, UUID, path) lines
+    The last line recorded for a UUID wins
+    """
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, JOURNAL_FILENAME)
+        self.entries = {}
+        self._file = None
+        self.load()
+
+    def load(self):
+        self.entries.clear()
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) != 3:  # Partially written line from a killed run
+                    continue
+                state, image_reference_uuid, path = parts
+                self.entries[image_reference_uuid] = (state, path)
+
+    def state(self, image_reference_uuid: str) -> Optional[str]:
+        entry = self.entries.get(image_reference_uuid)
+        return entry[0] if entry else None
+
+    def is_done(self, image_reference_uuid: str, path: str) -> bool:
+        """ Check if an image was downloaded to `path` """
+        return self.entries.get(image_reference_uuid) == (STATE_DONE, path)
+
+    def record(self, image_reference_uuid: str, state: str, path: str):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._file = open(self.path, 'a')
+
+        self._file.write('{}\t{}\t{}\n'.format(state, image_reference_uuid, path))
+        self._file.flush()  # Hand each line to the OS so it survives the process being killed
+        self.entries[image_reference_uuid] = (state, path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
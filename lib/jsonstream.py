@@ -0,0 +1,186 @@
+# jsonstream.py (m3-download)
+"""
+Incremental reading and writing of large JSON arrays and JSON Lines files
+"""
+import json
+from typing import IO, Iterator
+
+from lib import metrics
+
+DEFAULT_CHUNK_SIZE = 1 << 16  # Characters read at a time
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',]'
+
+
+def iter_json_array(f: IO[str], chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator:
+    """ Yield the elements of a top-level JSON array from a text file one at a time, without loading the whole file """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def read_more(size=chunk_size):
+        nonlocal buffer, pos, eof
+        data = f.read(size)
+        if not data:
+            eof = True
+        buffer = buffer[pos:] + data
+        pos = 0
+
+    def next_char():
+        """ Skip whitespace and return the next character without consuming it ('' at end of file) """
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return buffer[pos] if pos < len(buffer) else ''
+            read_more()
+
+    if next_char() != '[':
+        raise ValueError('Expected a JSON array')
+    pos += 1
+
+    if next_char() == ']':
+        return
+
+    while True:
+        # Decode the next element, reading more until it is complete
+        next_char()
+        read_size = chunk_size
+        with metrics.timer('json.decode'):
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # A value not followed by a delimiter may be truncated at the buffer edge (e.g. a number)
+                    if eof or (end < len(buffer) and buffer[end] in DELIMITERS):
+                        break
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                read_more(read_size)
+                read_size *= 2  # Grow reads for large elements to avoid re-parsing them many times
+        pos = end
+        yield value
+
+        c = next_char()
+        if c == ']':
+            return
+        if c != ',':
+            raise ValueError('Expected , or ] in JSON array at character {}'.format(pos))
+        pos += 1
+
+
+class JSONArrayWriter:
+    """
+    Write a JSON array one element at a time
+    The output is identical to json.dump(elements, f, indent=indent) for an array nested `level` levels deep
+    """
+
+    def __init__(self, f: IO[str], indent: int = 2, level: int = 0):
+        self.f = f
+        self.indent = indent
+        self.level = level
+        self.count = 0
+        self._prefix = '\n' + ' ' * (indent * (level + 1))
+        self._closed = False
+        self.f.write('[')
+
+    def write(self, element):
+        if self.count:
+            self.f.write(',')
+        self.f.write(self._prefix)
+        with metrics.timer('json.encode'):
+            self.f.write(json.dumps(element, indent=self.indent).replace('\n', self._prefix))
+        self.count += 1
+
+    def extend(self, elements):
+        for element in elements:
+            self.write(element)
+
+    def close(self):
+        if self._closed:
+            return
+        if self.count:
+            self.f.write('\n' + ' ' * (self.indent * self.level))
+        self.f.write(']')
+        self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def iter_jsonl(f: IO[str]) -> Iterator:
+    """ Yield the records of a JSON Lines file, skipping blank lines and a partially written last line """
+    for line in f:
+        if not line.strip():
+            continue
+        if not line.endswith('\n'):  # Last line of an interrupted write
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                pass
+            return
+        with metrics.timer('json.decode'):
+            record = json.loads(line)
+        yield record
+
+
+def repair_jsonl(path: str):
+    """ Truncate a partially written last line from a JSON Lines file so it can be appended to """
+    with open(path, 'rb+') as f:
+        f.seek(0, 2)
+        size = f.tell()
+        if size == 0:
+            return
+
+        # Scan back to the last newline
+        pos = size
+        while pos > 0:
+            step = min(DEFAULT_CHUNK_SIZE, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            idx = chunk.rfind(b'\n')
+            if idx != -1:
+                pos = pos - step + idx + 1
+                break
+            pos -= step
+
+        if pos != size:
+            f.truncate(pos)
+
+
+def iter_json_file(path: str) -> Iterator:
+    """ Yield the records of a JSON array (.json) or JSON Lines (.jsonl) file incrementally """
+    with open(path) as f:
+        if path.endswith('.jsonl'):
+            yield from iter_jsonl(f)
+        else:
+            yield from iter_json_array(f)
+
+
+def dump_object(items, f: IO[str], indent: int = 2):
+    """
+    Write a JSON object from (key, value) pairs, streaming any iterator values as arrays element by element
+    The output is identical to json.dump(dict(items), f, indent=indent) with the iterators as lists
+    """
+    prefix = '\n' + ' ' * indent
+    f.write('{')
+    n_items = 0
+    for key, value in items:
+        if n_items:
+            f.write(',')
+        f.write(prefix + json.dumps(key) + ': ')
+        if value is None or isinstance(value, (dict, list, tuple, str, int, float, bool)):
+            f.write(json.dumps(value, indent=indent).replace('\n', prefix))
+        else:
+            with JSONArrayWriter(f, indent=indent, level=1) as writer:
+                writer.extend(value)
+        n_items += 1
+
+    if n_items:
+        f.write('\n')
+    f.write('}')
@@ -1,12 +1,20 @@
 # localization.py (m3-download)
-import json
 import os
-from typing import List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
 from uuid import UUID
 import xml.etree.ElementTree as ETree
-from xml.dom import minidom
+
+import numpy as np
 from PIL import Image
 
+from lib import metrics
+from lib.image_index import ImageIndex
+from lib.jsonstream import dump_object
+from lib.transcode import image_map_path
+
+XML_WRITE_CHUNK_SIZE = 64  # Annotations sent to each XML writer process at a time
+
 
 class Localization:
     __slots__ = ['x', 'y', 'width', 'height']
@@ -46,6 +54,194 @@ class Localization:
         return self.points_min + self.points_max
 
 
+class LocalizationTable:
+    """
+    Columnar collection of localizations
+    Box coordinates are stored in a NumPy structured array, with concepts and image reference UUIDs as integer codes
+    Coordinates are integers unless a localization has a float coordinate, in which case a per-localization bit mask
+    records which coordinates were floats, so that each box keeps its own types on output
+    """
+    COORDINATES = ('x', 'y', 'width', 'height')
+    FLOAT_BITS = (1, 2, 4, 8)  # Bit of each coordinate in the float mask
+
+    def __init__(self, records: np.ndarray, concepts: List[str], image_reference_uuids: List[str]):
+        self.records = records
+        self.concepts = concepts
+        self.image_reference_uuids = image_reference_uuids
+
+    @staticmethod
+    def dtype(coordinate_dtype=np.int64) -> np.dtype:
+        return np.dtype([
+            ('x', coordinate_dtype),
+            ('y', coordinate_dtype),
+            ('width', coordinate_dtype),
+            ('height', coordinate_dtype),
+            ('concept', np.int32),  # Index into concepts
+            ('image', np.int32),  # Index into image_reference_uuids (-1 if unknown)
+            ('association', 'S16'),  # Association UUID bytes
+            ('float', np.uint8)  # Float mask (see FLOAT_BITS)
+        ])
+
+    @classmethod
+    def from_localizations(cls, localizations: List[dict]) -> 'LocalizationTable':
+        """ Build a table from extracted localizations (see extract_localizations.py) """
+        concept_codes = {}
+        image_codes = {}
+
+        columns = {k: [] for k in cls.COORDINATES}
+        concept_column = []
+        image_column = []
+        association_column = []
+        float_column = []
+        for ann in localizations:
+            loc = ann['localization']
+            float_mask = 0
+            for k, bit in zip(cls.COORDINATES, cls.FLOAT_BITS):
+                columns[k].append(loc[k])
+                if isinstance(loc[k], float):
+                    float_mask |= bit
+            float_column.append(float_mask)
+
+            concept_column.append(concept_codes.setdefault(ann['concept'], len(concept_codes)))
+            if 'image_reference_uuid' in loc:
+                image_column.append(image_codes.setdefault(loc['image_reference_uuid'], len(image_codes)))
+            else:
+                image_column.append(-1)
+            association_column.append(UUID(ann['association_uuid']).bytes)
+
+        # Keep integer coordinates as integers so output formats are unchanged (see box_lists for mixed tables)
+        coordinates = {k: np.asarray(v) for k, v in columns.items()}
+        coordinate_dtype = np.float64 if any(float_column) else np.int64
+
+        records = np.empty(len(localizations), dtype=cls.dtype(coordinate_dtype))
+        for k, a in coordinates.items():
+            records[k] = a
+        records['concept'] = concept_column
+        records['image'] = image_column
+        records['association'] = association_column
+        records['float'] = float_column
+
+        return cls(records, list(concept_codes), list(image_codes))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, item) -> Localization:
+        return Localization(*self.box_lists([item])[0])
+
+    @property
+    def is_integer(self) -> bool:
+        """ Whether all coordinates are integers """
+        return np.issubdtype(self.records['x'].dtype, np.integer)
+
+    def box_lists(self, indices: np.ndarray = None) -> List[list]:
+        """ Boxes as [x, y, width, height] lists of Python numbers, each coordinate with its type in the input """
+        records = self.records if indices is None else self.records[indices]
+        boxes = np.stack([records[k] for k in self.COORDINATES], axis=1).tolist()
+        if self.is_integer:
+            return boxes
+
+        for box, float_mask in zip(boxes, records['float'].tolist()):
+            if float_mask == 15:  # All floats
+                continue
+            for i, bit in enumerate(self.FLOAT_BITS):
+                if not float_mask & bit:
+                    box[i] = int(box[i])
+        return boxes
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.records['x']
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.records['y']
+
+    @property
+    def width(self) -> np.ndarray:
+        return self.records['width']
+
+    @property
+    def height(self) -> np.ndarray:
+        return self.records['height']
+
+    @property
+    def area(self) -> np.ndarray:
+        return self.width * self.height
+
+    @property
+    def xmax(self) -> np.ndarray:
+        return self.x + self.width
+
+    @property
+    def ymax(self) -> np.ndarray:
+        return self.y + self.height
+
+    @property
+    def boxes(self) -> np.ndarray:
+        """ (N, 4) array of x, y, width, height """
+        return np.stack([self.x, self.y, self.width, self.height], axis=1)
+
+    @property
+    def corners(self) -> np.ndarray:
+        """ (N, 4) array of xmin, ymin, xmax, ymax """
+        return np.stack([self.x, self.y, self.xmax, self.ymax], axis=1)
+
+    def scaled(self, image_scales: dict) -> 'LocalizationTable':
+        """
+        Copy of the table with the boxes of each image scaled by its (x, y) factors (see lib/transcode.py)
+        Box corners are scaled, then rounded where the coordinates they are made of are integers
+        """
+        factors = np.ones((len(self.image_reference_uuids) + 1, 2))  # Last row for unknown images (code -1)
+        for code, image_reference_uuid in enumerate(self.image_reference_uuids):
+            if image_reference_uuid in image_scales:
+                factors[code] = image_scales[image_reference_uuid]
+
+        image_factors = factors[self.records['image']]
+        rows = np.flatnonzero((image_factors != 1).any(axis=1))  # Boxes of other images are left exactly as they are
+        corners = self.corners[rows] * np.tile(image_factors[rows], 2)
+
+        records = self.records.copy()
+        if self.is_integer:
+            corners = np.rint(corners)
+        else:
+            float_mask = records['float'][rows]
+            x_bit, y_bit, width_bit, height_bit = self.FLOAT_BITS
+            corner_bits = np.array([x_bit, y_bit, x_bit | width_bit, y_bit | height_bit])
+            corners = np.where(float_mask[:, None] & corner_bits, corners, np.rint(corners))
+            # A scaled width (height) is only an integer if both of its corners are
+            records['float'][rows] = float_mask | (float_mask & (x_bit | y_bit)) << 2
+
+        records['x'][rows] = corners[:, 0]
+        records['y'][rows] = corners[:, 1]
+        records['width'][rows] = corners[:, 2] - corners[:, 0]
+        records['height'][rows] = corners[:, 3] - corners[:, 1]
+        return LocalizationTable(records, self.concepts, self.image_reference_uuids)
+
+    def concept_names(self, indices: np.ndarray = None) -> List[str]:
+        codes = self.records['concept'] if indices is None else self.records['concept'][indices]
+        return [self.concepts[code] for code in codes.tolist()]
+
+    def association_ints(self, indices: np.ndarray = None) -> List[int]:
+        """ Association UUIDs as integers """
+        associations = self.records['association'] if indices is None else self.records['association'][indices]
+        return [int.from_bytes(b.ljust(16, b'\0'), 'big') for b in associations.tolist()]
+
+    def group_by_image(self) -> Iterator[Tuple[str, np.ndarray]]:
+        """ Yield (image reference UUID, indices of its localizations) for each image, in first-seen order """
+        image_codes = self.records['image']
+        order = np.argsort(image_codes, kind='stable')
+        sorted_codes = image_codes[order]
+        boundaries = np.flatnonzero(np.diff(sorted_codes)) + 1
+        for indices in np.split(order, boundaries):
+            if not len(indices):
+                continue
+            code = int(image_codes[indices[0]])
+            if code < 0:  # Unknown image
+                continue
+            yield self.image_reference_uuids[code], indices
+
+
 class COCO:
     INFO_ATTRIBUTES = [
         'year',
@@ -119,6 +315,7 @@ class COCO:
                 self.add_license(license_info)
 
         self.annotations = []
+        self.annotation_tables: List[LocalizationTable] = []
 
         self.category_map = {}
         self.categories = []
@@ -165,19 +362,62 @@ class COCO:
                                                 image_id=UUID(loc['image_reference_uuid']).int,
                                                 category_id=self.category_map[ann['concept']]))
 
+    def add_annotations(self, table: LocalizationTable):
+        """ Add all localizations in a table (with a known image) as annotations """
+        self.annotation_tables.append(table)
+
+    @staticmethod
+    def table_annotations(table: LocalizationTable, category_map: dict) -> Iterator[dict]:
+        """ Generate annotation JSON for each localization in a table, in the same form as COCO.Annotation.json """
+        indices = np.flatnonzero(table.records['image'] >= 0)
+        if not len(indices):
+            return
+
+        records = table.records[indices]
+        boxes = table.box_lists(indices)
+        if table.is_integer:
+            areas = (records['width'] * records['height']).tolist()
+        else:
+            areas = [width * height for _, _, width, height in boxes]
+        image_ids = [UUID(iruuid).int for iruuid in table.image_reference_uuids]
+        category_ids = [category_map[concept] for concept in table.concepts]
+
+        for box, area, association_id, image_code, concept_code in zip(
+                boxes, areas, table.association_ints(indices), records['image'].tolist(), records['concept'].tolist()):
+            yield {
+                'bbox': box,
+                'area': area,
+                'id': association_id,
+                'image_id': image_ids[image_code],
+                'category_id': category_ids[concept_code]
+            }
+
+    def iter_annotations_json(self) -> Iterator[dict]:
+        for ann in self.annotations:
+            yield ann.json
+        for table in self.annotation_tables:
+            yield from COCO.table_annotations(table, self.category_map)
+
     @property
     def json(self):
         return {
             'info': self.info,
             'images': self.images,
-            'annotations': [ann.json for ann in self.annotations],
+            'annotations': list(self.iter_annotations_json()),
             'categories': self.categories,
             'licenses': self.licenses
         }
 
     def write(self, path):
+        """ Write the record as JSON, streaming the images and annotations so the full document is never built """
         with open(path, 'w') as f:
-            json.dump(self.json, f, indent=2)
+            dump_object([
+                ('info', self.info),
+                ('images', iter(self.images)),
+                ('annotations', self.iter_annotations_json()),
+                ('categories', self.categories),
+                ('licenses', self.licenses)
+            ], f, indent=2)
 
 
 class PascalVOC:
@@ -229,6 +469,10 @@ class PascalVOC:
 
         @property
         def xml(self) -> str:
+            return ETree.tostring(self.element, encoding='unicode')
+
+        @property
+        def element(self) -> ETree.Element:
             annotation = ETree.Element('annotation')  # Root
 
             # Meta
@@ -261,20 +505,16 @@ class PascalVOC:
 
                 xmin.text, ymin.text, xmax.text, ymax.text = tuple(map(str, loc.points))
 
-            return ETree.tostring(annotation, encoding='unicode')
+            return annotation
 
-    def __init__(self):
+    def __init__(self, image_index: Optional[ImageIndex] = None):
         self.annotations: List[PascalVOC.Annotation] = []
+        self.image_index = image_index  # Image sizes are read from the index when given
 
     def add_annotation(self, image_reference_uuid: str, anns: List[dict], image_map: dict):
         if not anns:
             return
 
-        if image_reference_uuid in image_map:
-            filename = image_map[image_reference_uuid]
-        else:
-            raise ValueError(f'No image found for image reference UUID {image_reference_uuid}')
-
         names = []
         localizations = []
         for ann in anns:
@@ -282,13 +522,26 @@ class PascalVOC:
             names.append(ann['concept'])
             localizations.append(Localization(loc['x'], loc['y'], loc['width'], loc['height']))
 
+        self.add_localizations(image_reference_uuid, names, localizations, image_map)
+
+    def add_localizations(self, image_reference_uuid: str, names: List[str], localizations: List[Localization],
+                          image_map: dict):
+        if image_reference_uuid in image_map:
+            filename = image_map_path(image_map[image_reference_uuid])
+        else:
+            raise ValueError(f'No image found for image reference UUID {image_reference_uuid}')
+
         if not os.path.exists(filename):
             print('[WARNING] No image found at {}, skipping'.format(filename))
             return
 
-        with Image.open(filename) as im:
-            width, height = im.size
-            depth = len(im.getbands())
+        info = self.image_index.get_or_probe(image_reference_uuid, filename) if self.image_index is not None else None
+        if info is not None:  # No need to open the image
+            width, height, depth = info.width, info.height, info.bands
+        else:
+            with metrics.timer('image.open'), Image.open(filename) as im:
+                width, height = im.size
+                depth = len(im.getbands())
 
         annotation = PascalVOC.Annotation(
             os.path.dirname(filename),
@@ -299,9 +552,43 @@ class PascalVOC:
 
         self.annotations.append(annotation)
 
-    def write(self, dirpath, form):
+    def add_annotations(self, table: LocalizationTable, image_map: dict):
+        """ Add an annotation for each image in a localization table """
+        boxes = table.box_lists()
+        for image_reference_uuid, indices in table.group_by_image():
+            names = table.concept_names(indices)
+            localizations = [Localization(*boxes[i]) for i in indices.tolist()]
+            self.add_localizations(image_reference_uuid, names, localizations, image_map)
+
+    def write(self, dirpath, form, n_workers: int = 1):
+        """ Write each annotation to an XML file in `dirpath`, optionally serializing them in `n_workers` processes """
         os.makedirs(dirpath, exist_ok=True)  # Make directory if doesn't exist
 
-        for annotation in self.annotations:
-            with open(os.path.join(dirpath, form.format(os.path.splitext(annotation.filename)[0])), 'w') as f:
-                f.write('\n'.join(minidom.parseString(annotation.xml).toprettyxml(indent=' '*4).splitlines()[1:]))
+        jobs = (
+            (os.path.join(dirpath, form.format(os.path.splitext(annotation.filename)[0])), annotation)
+            for annotation in self.annotations
+        )
+        if n_workers > 1:
+            with ProcessPoolExecutor(n_workers) as executor:
+                for _ in executor.map(_write_annotation, jobs, chunksize=XML_WRITE_CHUNK_SIZE):
+                    pass
+        else:
+            for job in jobs:
+                _write_annotation(job)
+
+
+def format_xml(element: ETree.Element, indent: str = ' ' * 4) -> str:
+    """ Pretty-print an XML element without an XML declaration. The element's whitespace is modified in place """
+    ETree.indent(element, space=indent)
+    return ETree.tostring(element, encoding='unicode')
+
+
+def write_xml(path: str, element: ETree.Element, indent: str = ' ' * 4):
+    """ Pretty-print an XML element to a file """
+    with metrics.timer('xml.write'), open(path, 'w') as f:
+        f.write(format_xml(element, indent=indent))
+
+
+def _write_annotation(path_annotation: Tuple[str, PascalVOC.Annotation]):
+    path, annotation = path_annotation
+    write_xml(path, annotation.element)
@@ -1,19 +1,60 @@
 # m3_requests.py (m3-download)
+import time
 from json import JSONDecodeError
 
 import requests
 
+from lib import metrics
+from lib.cache import get_cache
 from lib.config import Config
+from lib.session import get_session, get_timeout
+
+
+def m3_get(config: Config, url: str, endpoint: str = 'm3') -> requests.Response:
+    """ GET a URL through the shared session for `config`, timed under http.<endpoint> """
+    t0 = time.perf_counter()
+    res = get_session(config).get(url, timeout=get_timeout(config))
+    metrics.record('http.' + endpoint, time.perf_counter() - t0, len(res.content))
+    return res
+
+
+def m3_get_json(config: Config, url: str, endpoint: str = 'm3'):
+    """ GET a URL and decode its JSON response """
+    res = m3_get(config, url, endpoint)
+    with metrics.timer('json.decode'):
+        return res.json()
+
+
+def m3_get_cached(config: Config, endpoint: str, key: str, refresh: bool = False):
+    """
+    GET the decoded JSON at an M3 endpoint + key, serving it from the response cache when possible
+    If `refresh` is set, the cached response is not used but is still replaced
+    """
+    cache = get_cache(config)
+    if cache is not None and not refresh:
+        with metrics.timer('cache.get'):
+            data = cache.get(endpoint, key)
+        if data is not None:
+            return data
+
+    res = m3_get(config, config('m3', endpoint) + '/' + key, endpoint)
+    with metrics.timer('json.decode'):
+        data = res.json()
+    if cache is not None and res.status_code == 200:
+        cache.put(endpoint, key, data)
+
+    return data
 
 
 def get_fast_concept_images(config: Config, concept: str):
     try:
-        return requests.get(config('m3', 'fastconceptimages') + '/' + concept).json()
-    except JSONDecodeError:
+        return m3_get_json(config, config('m3', 'fastconceptimages') + '/' + concept, 'fastconceptimages')
+    except (JSONDecodeError, requests.RequestException):
         print('[ERROR] Failed to get observations for concept: {}'.format(concept))
 
 
 def get_concept_descendants(config: Config, concept: str) -> list:
+    """ Get the names of all descendants of a concept, sorted so that digests are merged in a stable order """
     def recursive_accumulate(tree):
         names = set()
         if 'children' not in tree:
@@ -25,21 +66,18 @@ def get_concept_descendants(config: Config, concept: str) -> list:
 
         return names
 
-    url = config('m3', 'kbdesc')
-    res = requests.get(url + '/' + concept)
-
-    return recursive_accumulate(res.json())
+    return sorted(recursive_accumulate(m3_get_cached(config, 'kbdesc', concept)))
 
 
-def get_imaged_moment_data(config: Config, imaged_moment_uuid: str):
+def get_imaged_moment_data(config: Config, imaged_moment_uuid: str, refresh: bool = False):
     try:
-        return requests.get(config('m3', 'imagedmoment') + '/' + imaged_moment_uuid.lower()).json()
-    except JSONDecodeError:
+        return m3_get_cached(config, 'imagedmoment', imaged_moment_uuid.lower(), refresh)
+    except (JSONDecodeError, requests.RequestException):
         print('[ERROR] Failed to get imaged moment data for UUID: {}'.format(imaged_moment_uuid.lower()))
 
 
 def get_image_reference_data(config: Config, image_reference_uuid: str):
     try:
-        return requests.get(config('m3', 'imagereference') + '/' + image_reference_uuid.lower()).json()
-    except JSONDecodeError:
+        return m3_get_cached(config, 'imagereference', image_reference_uuid.lower())
+    except (JSONDecodeError, requests.RequestException):
         print('[ERROR] Failed to get image reference data for UUID: {}'.format(image_reference_uuid.lower()))
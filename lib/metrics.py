@@ -0,0 +1,158 @@
+# metrics.py (m3-download)
+"""
+Lightweight timers and counters for profiling the pipeline scripts (--profile, --cprofile)
+Metrics are only recorded once enabled, and are kept per process
+"""
+import bisect
+import contextlib
+import cProfile
+import json
+import sys
+import threading
+import time
+from typing import Optional
+
+# Latency histogram bucket upper bounds, in milliseconds (the last bucket is unbounded)
+BUCKET_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_enabled = False
+_lock = threading.Lock()
+_timers = {}
+_stages = []
+_t0 = time.perf_counter()
+_null = contextlib.nullcontext()
+
+
+class TimerStats:
+    """ Count, total and maximum time, bytes and latency histogram of one kind of operation """
+    __slots__ = ['count', 'seconds', 'max_seconds', 'n_bytes', 'buckets']
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.
+        self.max_seconds = 0.
+        self.n_bytes = 0
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+
+    def record(self, seconds: float, n_bytes: int = 0):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.n_bytes += n_bytes
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, seconds * 1000)] += 1
+
+    def percentile_ms(self, q: float) -> Optional[float]:
+        """ Upper bound of the histogram bucket containing a percentile (the maximum for the last bucket) """
+        if not self.count:
+            return None
+        target = q / 100 * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKET_BOUNDS_MS, self.buckets):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return round(self.max_seconds * 1000, 3)
+
+    @property
+    def json(self):
+        return {
+            'count': self.count,
+            'seconds': round(self.seconds, 6),
+            'mean_ms': round(self.seconds / self.count * 1000, 3) if self.count else None,
+            'p50_ms': self.percentile_ms(50),
+            'p99_ms': self.percentile_ms(99),
+            'max_ms': round(self.max_seconds * 1000, 3),
+            'bytes': self.n_bytes,
+            'histogram': {
+                'le_ms': list(BUCKET_BOUNDS_MS) + [None],
+                'counts': self.buckets
+            }
+        }
+
+
+def enable():
+    global _enabled, _t0
+    _enabled = True
+    _t0 = time.perf_counter()
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def record(name: str, seconds: float, n_bytes: int = 0):
+    """ Record one timed operation (no-op unless enabled) """
+    if not _enabled:
+        return
+    with _lock:
+        stats = _timers.get(name)
+        if stats is None:
+            stats = _timers[name] = TimerStats()
+        stats.record(seconds, n_bytes)
+
+
+@contextlib.contextmanager
+def _timed(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t0)
+
+
+def timer(name: str):
+    """ Context manager timing an operation under `name` (a shared no-op unless enabled) """
+    return _timed(name) if _enabled else _null
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """ Context manager recording the wall time of a script stage """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _enabled:
+            with _lock:
+                _stages.append({'name': name, 'seconds': round(time.perf_counter() - t0, 6)})
+
+
+def report() -> dict:
+    with _lock:
+        return {
+            'argv': sys.argv,
+            'wall_seconds': round(time.perf_counter() - _t0, 6),
+            'stages': list(_stages),
+            'timers': {name: _timers[name].json for name in sorted(_timers)}
+        }
+
+
+def write_report(path: str):
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=2)
+
+
+@contextlib.contextmanager
+def profile(report_path: Optional[str] = None, cprofile_path: Optional[str] = None):
+    """
+    Profile the enclosed code: write a JSON metrics report to `report_path` and/or cProfile stats to `cprofile_path`
+    Reports are written even if the code exits early
+    """
+    if report_path is not None:
+        enable()
+
+    profiler = None
+    if cprofile_path is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+            print('[INFO] Wrote cProfile stats to {}'.format(cprofile_path))
+        if report_path is not None:
+            write_report(report_path)
+            print('[INFO] Wrote profile report to {}'.format(report_path))
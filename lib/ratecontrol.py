@@ -0,0 +1,190 @@
+# ratecontrol.py (m3-download)
+"""
+Adaptive (AIMD) per-host concurrency limits for HTTP requests, enforced by the session adapter
+"""
+import os
+import threading
+import time
+import weakref
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+from lib import metrics
+from lib.config import Config
+
+# Defaults used when the config has no [http] rate control settings
+DEFAULT_RATE_CONTROL = True
+DEFAULT_INITIAL_LIMIT = 4
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_LATENCY_FACTOR = 3.0
+DEFAULT_DECREASE_FACTOR = 0.5
+
+BASELINE_DRIFT = 0.01  # Fraction of the gap to a slower latency the baseline moves per request
+ERROR_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit for one host, adapted to its responses
+    Each request that completes without an error or a slowdown raises the limit by 1 / limit (about 1 per round of
+    requests), or by 1 until the first decrease (slow start). An error (connection failure, 429/5xx or retry) or a time
+    to first byte above `latency_factor` times the baseline multiplies the limit by `decrease_factor`, at most once per
+    round of requests. The baseline tracks the fastest recent time to first byte
+    """
+
+    def __init__(self, host: str, initial_limit: int, min_limit: int, max_limit: int,
+                 latency_factor: float = DEFAULT_LATENCY_FACTOR, decrease_factor: float = DEFAULT_DECREASE_FACTOR):
+        self.host = host
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.latency_factor = latency_factor
+        self.decrease_factor = decrease_factor
+
+        self.limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self.in_flight = 0
+        self.baseline = None
+        self.slow_start = True
+
+        self.requests = 0
+        self.errors = 0
+        self.decreases = 0
+        self.peak_limit = self.limit
+        self._next_decrease = 0  # Request count before which no further decrease happens
+
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """ Wait for a free slot under the current limit """
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float, error: bool = False):
+        """ Free a slot and adapt the limit to the outcome of the request """
+        with self._cond:
+            self.in_flight -= 1
+            self.requests += 1
+
+            congested = error
+            if error:
+                self.errors += 1
+            elif self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                congested = latency > self.baseline * self.latency_factor
+                self.baseline += (latency - self.baseline) * BASELINE_DRIFT
+
+            if congested:
+                if self.requests >= self._next_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self.slow_start = False
+                    self.decreases += 1
+                    self._next_decrease = self.requests + self.in_flight + 1  # Let the current round drain first
+            elif self.in_flight + 1 >= int(self.limit):  # Only grow a limit that is actually being used
+                self.limit = min(self.max_limit, self.limit + (1 if self.slow_start else 1 / self.limit))
+                self.peak_limit = max(self.peak_limit, self.limit)
+
+            self._cond.notify_all()
+
+    @property
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'limit': int(self.limit),
+                'peak_limit': int(self.peak_limit),
+                'requests': self.requests,
+                'errors': self.errors,
+                'decreases': self.decreases
+            }
+
+
+def is_enabled(config: Config) -> bool:
+    return config.getboolean('http', 'rate_control', fallback=DEFAULT_RATE_CONTROL)
+
+
+def get_limiter(config: Config, host: str, max_limit: int) -> AIMDLimiter:
+    """ Get the limiter of a host for a config, shared by all sessions of the process """
+    key = (config.path, os.getpid(), host)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = AIMDLimiter(
+                host,
+                initial_limit=config.getint('http', 'initial_limit', fallback=DEFAULT_INITIAL_LIMIT),
+                min_limit=config.getint('http', 'min_limit', fallback=DEFAULT_MIN_LIMIT),
+                max_limit=config.getint('http', 'max_limit', fallback=max_limit),
+                latency_factor=config.getfloat('http', 'latency_factor', fallback=DEFAULT_LATENCY_FACTOR),
+                decrease_factor=config.getfloat('http', 'decrease_factor', fallback=DEFAULT_DECREASE_FACTOR)
+            )
+            _limiters[key] = limiter
+        return limiter
+
+
+class RateControlledAdapter(HTTPAdapter):
+    """
+    HTTP adapter that holds a slot of the host's limiter from sending a request until its response body is released
+    The time to first byte (including any retries) and errors drive the limit
+    """
+
+    def __init__(self, config: Config, max_limit: int, **kwargs):
+        self._config = config  # HTTPAdapter has its own (unused) config attribute
+        self._max_limit = max_limit
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        limiter = get_limiter(self._config, urlsplit(request.url).netloc, self._max_limit)
+        with metrics.timer('http.wait'):
+            limiter.acquire()
+        t0 = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except BaseException:
+            limiter.release(time.perf_counter() - t0, error=True)
+            raise
+
+        retries = getattr(response.raw, 'retries', None)
+        error = response.status_code in ERROR_STATUS_CODES or bool(retries is not None and retries.history)
+        release_on_completion(response.raw, limiter, time.perf_counter() - t0, error)
+        return response
+
+
+def release_on_completion(raw, limiter: AIMDLimiter, latency: float, error: bool):
+    """ Release a limiter slot once, when the connection of a response is released (or the response is discarded) """
+    lock = threading.Lock()
+    released = False
+
+    def release():
+        nonlocal released
+        with lock:
+            if released:
+                return
+            released = True
+        limiter.release(latency, error)
+
+    release_conn = raw.release_conn
+
+    def release_conn_and_slot():
+        try:
+            release_conn()
+        finally:
+            release()
+
+    raw.release_conn = release_conn_and_slot
+    weakref.finalize(raw, release)
+
+
+def print_rate_control_stats(config: Config):
+    """ Print the concurrency limit reached for each host (no-op if nothing was limited) """
+    with _limiters_lock:
+        limiters = [limiter for (path, pid, _), limiter in _limiters.items()
+                    if path == config.path and pid == os.getpid()]
+    for limiter in limiters:
+        stats = limiter.stats
+        print('[INFO] Rate control {}: limit {} (peak {}), {} requests, {} errors, {} decreases'.format(
+            limiter.host, stats['limit'], stats['peak_limit'], stats['requests'], stats['errors'], stats['decreases']
+        ))
@@ -0,0 +1,72 @@
+# session.py (m3-download)
+"""
+Pooled, keep-alive HTTP sessions shared by all M3 calls
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from lib.config import Config
+from lib.ratecontrol import RateControlledAdapter, is_enabled as rate_control_enabled
+
+# Defaults used when the config has no [http] section
+DEFAULT_POOL_SIZE = 32
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_timeout(config: Config) -> tuple:
+    """ Get the (connect, read) timeout tuple specified by the config """
+    return (
+        config.getfloat('http', 'connect_timeout', fallback=DEFAULT_CONNECT_TIMEOUT),
+        config.getfloat('http', 'read_timeout', fallback=DEFAULT_READ_TIMEOUT)
+    )
+
+
+def make_session(config: Config) -> requests.Session:
+    """
+    Build a new session with a sized connection pool and retry/backoff policy
+    Unless disabled, concurrent requests are limited per host by adaptive limits shared by all sessions of the process
+    """
+    pool_size = config.getint('http', 'pool_size', fallback=DEFAULT_POOL_SIZE)
+    retry = Retry(
+        total=config.getint('http', 'retries', fallback=DEFAULT_RETRIES),
+        backoff_factor=config.getfloat('http', 'backoff', fallback=DEFAULT_BACKOFF),
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False
+    )
+    if rate_control_enabled(config):
+        adapter = RateControlledAdapter(config, pool_size,
+                                        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    else:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(config: Config) -> requests.Session:
+    """
+    Get the shared session for a config, creating it on first use
+    Sessions are kept per process so that forked workers never share a connection pool
+    """
+    key = (config.path, os.getpid())
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = make_session(config)
+            _sessions[key] = session
+        return session
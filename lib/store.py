@@ -0,0 +1,111 @@
+# store.py (m3-download)
+"""
+Content-addressed image store shared between downloads
+"""
+import os
+import threading
+from typing import Optional
+
+INDEX_FILENAME = 'index.tsv'
+OBJECTS_DIRNAME = 'objects'
+
+
+class ImageStore:
+    """
+    Stores images as blobs named by their SHA-256 digest, with an index from image reference UUID to digest
+    Images are exposed in an output directory by hardlinking (or symlinking) to their blob
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = os.path.join(path, INDEX_FILENAME)
+        self.index = {}  # Image reference UUID -> blob name (digest + extension)
+
+        self._lock = threading.Lock()
+        self._index_file = None
+
+        os.makedirs(os.path.join(path, OBJECTS_DIRNAME), exist_ok=True)
+        self.load()
+
+    def load(self):
+        self.index.clear()
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path) as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) != 2:  # Partially written line from a killed run
+                    continue
+                image_reference_uuid, blob_name = parts
+                self.index[image_reference_uuid] = blob_name
+
+    def blob_path(self, blob_name: str) -> str:
+        return os.path.join(self.path, OBJECTS_DIRNAME, blob_name[:2], blob_name)
+
+    def digest(self, image_reference_uuid: str) -> Optional[str]:
+        """ Get the SHA-256 digest of a stored image, or None if it is not indexed """
+        blob_name = self.index.get(image_reference_uuid)
+        return os.path.splitext(blob_name)[0] if blob_name else None
+
+    def lookup(self, image_reference_uuid: str) -> Optional[str]:
+        """ Get the blob path of a stored image, or None if it is not in the store """
+        blob_name = self.index.get(image_reference_uuid)
+        if blob_name is None:
+            return None
+
+        blob_path = self.blob_path(blob_name)
+        if not os.path.exists(blob_path):
+            return None
+        return blob_path
+
+    def add(self, image_reference_uuid: str, temp_path: str, digest: str, ext: str = '') -> str:
+        """ Move a downloaded file into the store (deduplicating by digest) and index it. Returns the blob path """
+        blob_name = digest + ext.lower()
+        blob_path = self.blob_path(blob_name)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        if os.path.exists(blob_path):  # Same content already stored
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, blob_path)
+
+        with self._lock:
+            if self._index_file is None:
+                self._index_file = open(self.index_path, 'a')
+            self._index_file.write('{}\t{}\n'.format(image_reference_uuid, blob_name))
+            self._index_file.flush()
+            self.index[image_reference_uuid] = blob_name
+
+        return blob_path
+
+    @staticmethod
+    def link(blob_path: str, path: str, image_reference_uuid: Optional[str] = None):
+        """
+        Atomically expose a blob at `path`, by hardlink if possible and by symlink otherwise
+        Image references with the same URL share a path, so each links through its own temporary name
+        """
+        temp_path = path + '.link' if image_reference_uuid is None else '{}.{}.link'.format(path, image_reference_uuid)
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+
+        try:
+            os.link(blob_path, temp_path)
+        except OSError:  # Cross-device or unsupported file system
+            os.symlink(os.path.abspath(blob_path), temp_path)
+
+        os.replace(temp_path, path)
+        if os.path.lexists(temp_path):  # Renaming onto a hardlink of the same blob leaves both names in place
+            os.remove(temp_path)
+
+    def close(self):
+        with self._lock:
+            if self._index_file is not None:
+                self._index_file.close()
+                self._index_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,212 @@
+# transcode.py (m3-download)
+"""
+Resize and re-encode downloaded images, keeping the scale factors needed to rescale their localizations
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from typing import NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+from lib import metrics
+from lib.image_index import ImageInfo, probe_image
+
+INDEX_FILENAME = 'transcode_index.tsv'
+PARTIAL_SUFFIX = '.part'
+SOURCE_SUFFIX = '.src'  # Downloaded image, before transcoding
+
+DEFAULT_QUALITY = 90
+
+# Output format name -> file extension
+FORMATS = {
+    'JPEG': '.jpg',
+    'WEBP': '.webp',
+    'PNG': '.png'
+}
+MODES = {  # Output format name -> modes it can be saved in
+    'JPEG': ('RGB', 'L', 'CMYK'),
+    'WEBP': ('RGB', 'RGBA'),
+    'PNG': ('1', 'L', 'LA', 'I', 'P', 'RGB', 'RGBA')
+}
+
+
+class TranscodeOptions(NamedTuple):
+    max_side: Optional[int] = None  # Longest side, in pixels (None to keep the size)
+    format: Optional[str] = None  # Output format (None to keep the format)
+    quality: int = DEFAULT_QUALITY  # JPEG/WebP quality
+
+    def path(self, path: str) -> str:
+        """ Path of a transcoded image, with the extension of the output format """
+        if self.format is None:
+            return path
+        return os.path.splitext(path)[0] + FORMATS[self.format]
+
+
+def source_path(path: str, image_reference_uuid: str) -> str:
+    """
+    Path to download an image to before transcoding it to `path`
+    Image references with the same URL share a path, so each gets its own source file
+    """
+    return '{}.{}{}'.format(path, image_reference_uuid, SOURCE_SUFFIX)
+
+
+def transcode_image(src_path: str, path: str, options: TranscodeOptions) -> Tuple[float, float, ImageInfo]:
+    """
+    Shrink an image to fit the maximum side and/or re-encode it, writing it atomically to `path` and removing the source
+    Images that need neither are moved as they are, without re-encoding
+    Returns the (x, y) scale factors and the metadata of the written image
+    """
+    with metrics.timer('image.transcode'), Image.open(src_path) as im:
+        width, height = im.size
+        output_format = options.format or im.format
+
+        size = (width, height)
+        if options.max_side and max(width, height) > options.max_side:
+            scale = options.max_side / max(width, height)
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+        if size == (width, height) and output_format == im.format:
+            im.close()
+            os.replace(src_path, path)
+        else:
+            if size != (width, height):
+                im.draft(im.mode, size)  # JPEG: decode at a reduced scale that is still at least `size`
+                im = im.resize(size, Image.Resampling.LANCZOS)
+
+            if im.mode not in MODES.get(output_format, (im.mode,)):
+                im = im.convert('RGBA' if 'RGBA' in MODES[output_format] and im.has_transparency_data else 'RGB')
+
+            save_kwargs = {'quality': options.quality} if output_format in ('JPEG', 'WEBP') else {}
+            temp_path = src_path + PARTIAL_SUFFIX  # Unique per image reference, like the source
+            im.save(temp_path, format=output_format, **save_kwargs)
+            os.replace(temp_path, path)
+            if src_path != path:
+                os.remove(src_path)
+
+    return size[0] / width, size[1] / height, probe_image(path)
+
+
+def transcode_job(args):
+    """ Process pool entry point: transcode an (image reference UUID, source path, path, options) job """
+    image_reference_uuid, src_path, path, options = args
+    try:
+        return image_reference_uuid, path, transcode_image(src_path, path, options)
+    except (OSError, ValueError) as e:
+        print('[WARNING] Failed to transcode {}: {}'.format(src_path, e))
+        return image_reference_uuid, path, None
+
+
+class TranscodePool:
+    """
+    Process pool transcoding images as they are submitted
+    Results are (image reference UUID, path, (x scale, y scale, image metadata) or None on failure)
+    """
+
+    def __init__(self, options: TranscodeOptions, n_workers: Optional[int] = None):
+        self.options = options
+        # Spawn rather than fork: images are submitted while download threads are running
+        self._executor = ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn'))
+        self._pending = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, image_reference_uuid: str, src_path: str, path: str):
+        self._pending.add(self._executor.submit(transcode_job, (image_reference_uuid, src_path, path, self.options)))
+
+    def completed(self):
+        """ Yield the results of the transcodes finished so far, without waiting """
+        done, self._pending = wait(self._pending, timeout=0)
+        for future in done:
+            yield future.result()
+
+    def finish(self):
+        """ Wait for the remaining transcodes, yielding their results as they complete, and shut down the pool """
+        pending, self._pending = self._pending, set()
+        for future in as_completed(pending):
+            yield future.result()
+        self._executor.shutdown()
+
+
+class ScaleIndex:
+    """
+    Append-only, tab-separated index of (image reference UUID, path, x scale, y scale) of transcoded images
+    The last line for a UUID wins
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+
+        self._lock = threading.Lock()
+        self._file = None
+
+        self.load()
+
+    @classmethod
+    def for_directory(cls, output_dir: str) -> 'ScaleIndex':
+        return cls(os.path.join(output_dir, INDEX_FILENAME))
+
+    def load(self):
+        self.entries.clear()
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) != 4:  # Partially written line from a killed run
+                    continue
+                image_reference_uuid, path, scale_x, scale_y = parts
+                self.entries[image_reference_uuid] = (path, float(scale_x), float(scale_y))
+
+    def get(self, image_reference_uuid: str, path: str) -> Optional[Tuple[float, float]]:
+        """ Get the scale factors of an image transcoded to `path` """
+        entry = self.entries.get(image_reference_uuid)
+        if entry is None or entry[0] != path:
+            return None
+        return entry[1:]
+
+    def add(self, image_reference_uuid: str, path: str, scale_x: float, scale_y: float):
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._file = open(self.path, 'a')
+            self._file.write('{}\t{}\t{!r}\t{!r}\n'.format(image_reference_uuid, path, scale_x, scale_y))
+            self._file.flush()
+            self.entries[image_reference_uuid] = (path, scale_x, scale_y)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def image_map_entry(path: str, scale: Optional[Tuple[float, float]] = None):
+    """ Image map value: the image path, or {'path': ..., 'scale': [x, y]} for a transcoded image """
+    if scale is None:
+        return path
+    return {'path': path, 'scale': list(scale)}
+
+
+def image_map_path(entry) -> str:
+    """ Path of an image map value, in either form """
+    return entry['path'] if isinstance(entry, dict) else entry
+
+
+def image_map_scales(image_map: dict) -> dict:
+    """ Image reference UUID -> (x, y) scale factors of the transcoded images in an image map """
+    return {
+        image_reference_uuid: tuple(entry['scale'])
+        for image_reference_uuid, entry in image_map.items()
+        if isinstance(entry, dict) and 'scale' in entry
+    }
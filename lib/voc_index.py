@@ -0,0 +1,218 @@
+# voc_index.py (m3-download)
+"""
+Persistent, incrementally refreshed index of a directory of Pascal VOC annotation XMLs
+"""
+import os
+import re
+import sqlite3
+import xml.etree.ElementTree as ETree
+from concurrent.futures import ProcessPoolExecutor
+from html import unescape
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+INDEX_FILENAME = '.voc_index.sqlite'
+PARSE_CHUNK_SIZE = 64  # Files sent to each parser process at a time
+OBJECT_REGEX = re.compile(rb'<object[\s>]')
+OBJECT_NAME_REGEX = re.compile(rb'(<object>\s*<name>)(.*?)(</name>)')  # The <name> of an object, as its first child
+
+Box = Tuple[str, float, float, float, float]  # concept, xmin, ymin, xmax, ymax
+
+
+def parse_voc(path: str) -> Tuple[Optional[str], Optional[int], Optional[int], Optional[int], List[Box]]:
+    """ Parse a VOC annotation XML into (image filename, width, height, depth, boxes) """
+    root = ETree.parse(path).getroot()
+
+    filename = root.findtext('filename')
+    size = root.find('size')
+    width = height = depth = None
+    if size is not None:
+        width = int(size.findtext('width'))
+        height = int(size.findtext('height'))
+        depth = int(size.findtext('depth', default='1'))
+
+    boxes = []
+    for obj in root.findall('object'):
+        bndbox = obj.find('bndbox')
+        boxes.append((
+            obj.findtext('name'),
+            float(bndbox.findtext('xmin')),
+            float(bndbox.findtext('ymin')),
+            float(bndbox.findtext('xmax')),
+            float(bndbox.findtext('ymax'))
+        ))
+
+    return filename, width, height, depth, boxes
+
+
+def scan_concepts(path: str) -> Set[str]:
+    """
+    Find the concepts of the objects in a VOC annotation file with a raw byte scan (no XML parsing)
+    Other <name> elements (e.g. of <part>s or the <owner>) are ignored
+    Files with an object whose <name> is not its first child are parsed instead
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    matches = OBJECT_NAME_REGEX.findall(data)
+    if len(matches) != len(OBJECT_REGEX.findall(data)):
+        return set(obj.findtext('name') for obj in ETree.fromstring(data).findall('object'))
+    return set(unescape(name.decode('utf-8')) for _, name, _ in matches)
+
+
+def _parse_voc_safe(path: str):
+    try:
+        return path, parse_voc(path), None
+    except Exception as e:  # Malformed XML or missing elements
+        return path, None, str(e)
+
+
+class VOCIndex:
+    """
+    SQLite index of the files in a VOC annotation directory: image filename and size, and boxes per concept
+    Refreshing only re-parses files whose modification time or size changed
+    """
+
+    def __init__(self, directory: str, path: Optional[str] = None):
+        self.directory = directory
+        self.path = path or os.path.join(directory, INDEX_FILENAME)
+
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA foreign_keys=ON')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'id INTEGER PRIMARY KEY, '
+            'name TEXT UNIQUE NOT NULL, '
+            'mtime_ns INTEGER NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'filename TEXT, '
+            'width INTEGER, '
+            'height INTEGER, '
+            'depth INTEGER, '
+            'error TEXT)'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS boxes ('
+            'file_id INTEGER NOT NULL REFERENCES files (id) ON DELETE CASCADE, '
+            'concept TEXT, '
+            'xmin REAL, '
+            'ymin REAL, '
+            'xmax REAL, '
+            'ymax REAL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS boxes_file_id ON boxes (file_id)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS boxes_concept ON boxes (concept)')
+        self._conn.commit()
+
+    def refresh(self, n_workers: int = 1, verbose: bool = True) -> Tuple[int, int]:
+        """
+        Bring the index up to date with the directory, parsing new or modified XMLs in `n_workers` processes
+        Returns (number of files parsed, number of files removed)
+        """
+        # Stat the directory (scandir entries carry their stat on most platforms)
+        on_disk = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.xml') and entry.is_file():
+                    stat = entry.stat()
+                    on_disk[entry.name] = (stat.st_mtime_ns, stat.st_size)
+
+        indexed = {
+            name: (mtime_ns, size)
+            for name, mtime_ns, size in self._conn.execute('SELECT name, mtime_ns, size FROM files')
+        }
+
+        removed = [name for name in indexed if name not in on_disk]
+        changed = [name for name, stat in on_disk.items() if indexed.get(name) != stat]
+
+        self._conn.executemany('DELETE FROM files WHERE name = ?', ((name,) for name in removed + changed))
+
+        paths = [os.path.join(self.directory, name) for name in changed]
+        if n_workers > 1 and len(paths) > PARSE_CHUNK_SIZE:
+            with ProcessPoolExecutor(n_workers) as executor:
+                self._insert(executor.map(_parse_voc_safe, paths, chunksize=PARSE_CHUNK_SIZE), on_disk, verbose)
+        else:
+            self._insert(map(_parse_voc_safe, paths), on_disk, verbose)
+
+        self._conn.commit()
+        return len(changed), len(removed)
+
+    def _insert(self, results, on_disk: dict, verbose: bool):
+        for path, parsed, error in results:
+            name = os.path.basename(path)
+            mtime_ns, size = on_disk[name]
+            if parsed is None:
+                if verbose:
+                    print('[WARNING] Failed to parse {}: {}'.format(path, error))
+                self._conn.execute(
+                    'INSERT INTO files (name, mtime_ns, size, error) VALUES (?, ?, ?, ?)', (name, mtime_ns, size, error)
+                )
+                continue
+
+            filename, width, height, depth, boxes = parsed
+            cursor = self._conn.execute(
+                'INSERT INTO files (name, mtime_ns, size, filename, width, height, depth) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (name, mtime_ns, size, filename, width, height, depth)
+            )
+            self._conn.executemany(
+                'INSERT INTO boxes (file_id, concept, xmin, ymin, xmax, ymax) VALUES (?, ?, ?, ?, ?, ?)',
+                ((cursor.lastrowid,) + box for box in boxes)
+            )
+
+    def concept_counts(self) -> Dict[str, int]:
+        return dict(self._conn.execute('SELECT concept, COUNT(*) FROM boxes GROUP BY concept'))
+
+    def concepts(self) -> List[str]:
+        return [row[0] for row in self._conn.execute('SELECT DISTINCT concept FROM boxes ORDER BY concept')]
+
+    def paths(self) -> List[str]:
+        """ Paths of all indexed XMLs that were parsed successfully """
+        return [
+            os.path.join(self.directory, row[0])
+            for row in self._conn.execute('SELECT name FROM files WHERE error IS NULL ORDER BY name')
+        ]
+
+    def paths_with_concepts(self, concepts: Iterable[str]) -> List[str]:
+        """ Paths of indexed XMLs containing at least one box of any of `concepts` """
+        self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS query_concepts (concept TEXT PRIMARY KEY)')
+        self._conn.execute('DELETE FROM query_concepts')
+        self._conn.executemany('INSERT OR IGNORE INTO query_concepts VALUES (?)', ((c,) for c in concepts))
+        rows = self._conn.execute(
+            'SELECT DISTINCT files.name FROM files '
+            'JOIN boxes ON boxes.file_id = files.id '
+            'JOIN query_concepts ON query_concepts.concept = boxes.concept '
+            'ORDER BY files.name'
+        )
+        return [os.path.join(self.directory, row[0]) for row in rows]
+
+    def iter_annotations(self) -> Iterator[Tuple[str, Optional[int], Optional[int], List[Box]]]:
+        """ Yield (path, image width, image height, boxes) for each parsed XML, ordered by name """
+        rows = self._conn.execute(
+            'SELECT files.name, files.width, files.height, boxes.concept, boxes.xmin, boxes.ymin, boxes.xmax, boxes.ymax '
+            'FROM files LEFT JOIN boxes ON boxes.file_id = files.id '
+            'WHERE files.error IS NULL '
+            'ORDER BY files.name, boxes.rowid'
+        )
+
+        current = None
+        boxes = []
+        for name, width, height, *box in rows:
+            if current is not None and name != current[0]:
+                yield (os.path.join(self.directory, current[0]),) + current[1:] + (boxes,)
+                boxes = []
+            current = (name, width, height)
+            if box[0] is not None:
+                boxes.append(tuple(box))
+
+        if current is not None:
+            yield (os.path.join(self.directory, current[0]),) + current[1:] + (boxes,)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
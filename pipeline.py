@@ -0,0 +1,465 @@
+# pipeline.py (m3-download)
+"""
+Build a formatted dataset for a concept in one streaming run: observations, localizations, images and annotations
+"""
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional
+
+from download_images import (DOWNLOAD_FAILURE_FILENAME, get_image_url, index_image, iter_downloads,
+                             print_throughput)
+from extract_localizations import observation_localizations
+from generate_digest import fetch_concept_observations, iter_imaged_moment_additions
+from lib import metrics
+from lib.cache import configure_cache, print_cache_stats
+from lib.config import Config
+from lib.image_index import ImageIndex
+from lib.journal import DownloadJournal, STATE_DONE, STATE_FAILED
+from lib.jsonstream import JSONArrayWriter
+from lib.localization import COCO, LocalizationTable, PascalVOC
+from lib.m3_requests import get_concept_descendants
+from lib.ratecontrol import print_rate_control_stats
+from lib.store import ImageStore
+from lib.transcode import (DEFAULT_QUALITY, FORMATS as TRANSCODE_FORMATS, ScaleIndex, TranscodeOptions,
+                           TranscodePool, image_map_entry, source_path)
+from reformat import FORMATS, coco_images, formats_str
+
+QUEUE_SIZE = 1024  # Items buffered between stages
+IMAGES_DIRNAME = 'images'
+ANNOTATIONS_NAME = 'annotations'
+
+_DONE = object()  # End of stream marker
+
+
+class Stage(threading.Thread):
+    """ Pipeline stage thread. Marks the end of its output queue when done, and keeps any error for the main thread """
+
+    def __init__(self, name, target, output: queue.Queue):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.output = output
+        self.error = None
+
+    def run(self):
+        try:
+            self.target()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.output.put(_DONE)
+
+
+def iter_queue(q: queue.Queue):
+    """ Yield the items of a queue until the end of stream marker """
+    while True:
+        item = q.get()
+        if item is _DONE:
+            return
+        yield item
+
+
+class ArtifactWriter:
+    """ Optional intermediate artifact: a JSON array, or JSON Lines if the path ends with .jsonl """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.count = 0
+        self._f = None
+        self._writer = None
+        if path is not None:
+            self._f = open(path, 'w')
+            if not path.endswith('.jsonl'):
+                self._writer = JSONArrayWriter(self._f)
+
+    def write(self, record):
+        if self._f is None:
+            return
+        if self._writer is not None:
+            self._writer.write(record)
+        else:
+            self._f.write(json.dumps(record) + '\n')
+        self.count += 1
+
+    def close(self):
+        if self._f is None:
+            return
+        if self._writer is not None:
+            self._writer.close()
+        self._f.close()
+        print('Wrote {} records to {}'.format(self.count, self.path))
+
+
+def iter_observations(config, concept, include_descendants, include_all, concurrency=1):
+    """
+    Yield the unique observations of a concept (and its descendants) as they are fetched, then the other observations
+    in their imaged moments if `include_all` is set
+    No progress line is printed for the imaged moments, since it would overwrite the download progress
+    """
+    concepts = [concept]
+    if include_descendants:
+        concepts += list(get_concept_descendants(config, concept))
+        print('Included concepts: {}'.format(', '.join(concepts)))
+
+    observation_uuids = set()
+    imaged_moment_uuids = {}  # Ordered set
+    n_failed = 0
+    for c, observations, seconds in fetch_concept_observations(config, concepts, concurrency):
+        if observations is None:
+            n_failed += 1
+            print('{:<50}: {:>10} ({:.2f} s)'.format(c, 'FAILED', seconds))
+            continue
+        print('{:<50}: {:>10} observations ({:.2f} s)'.format(c, len(observations), seconds))
+
+        for obs in observations:
+            if obs['observation_uuid'] in observation_uuids:
+                continue
+            observation_uuids.add(obs['observation_uuid'])
+            imaged_moment_uuids[obs['imaged_moment_uuid']] = None
+            yield obs
+
+    if n_failed == len(concepts):
+        raise RuntimeError('Failed to get observations for {}'.format(', '.join(concepts)))
+
+    if include_all:
+        additions = iter_imaged_moment_additions(config, imaged_moment_uuids, observation_uuids, concurrency,
+                                                 progress=False)
+        for _, added in additions:
+            yield from added
+
+
+def run_pipeline(config, concept, output_dir, format_type, include_descendants=False, include_all=False,
+                 concurrency=8, n_workers=8, overwrite=False, store_dir=None, digest_path=None,
+                 localizations_path=None, image_map_path=None, transcode_options=None, n_transcode_workers=None):
+    images_dir = os.path.join(output_dir, IMAGES_DIRNAME)
+    os.makedirs(images_dir, exist_ok=True)
+
+    observation_queue = queue.Queue(QUEUE_SIZE)
+    download_queue = queue.Queue(QUEUE_SIZE)
+    localizations = []
+
+    # Stage 1: observations, streamed from M3 as they are fetched
+    def fetch_observations():
+        digest = ArtifactWriter(digest_path)
+        try:
+            for obs in iter_observations(config, concept, include_descendants, include_all, concurrency):
+                digest.write(obs)
+                observation_queue.put(obs)
+        finally:
+            digest.close()
+
+    # Stage 2: localizations, queueing each newly seen image for download
+    # Images without a URL in the observation are looked up concurrently, and queued as soon as they are resolved
+    def extract_localizations():
+        artifact = ArtifactWriter(localizations_path)
+        seen_images = set()
+
+        def resolve(image_reference_uuid):
+            download_queue.put((image_reference_uuid, get_image_url(config, image_reference_uuid)))
+
+        lookups = []
+        try:
+            with ThreadPoolExecutor(concurrency) as resolver:
+                for obs in iter_queue(observation_queue):
+                    for loc in observation_localizations(obs):
+                        localizations.append(loc)
+                        artifact.write(loc)
+
+                        image_reference_uuid = loc['localization'].get('image_reference_uuid')
+                        if image_reference_uuid is None or image_reference_uuid in seen_images:
+                            continue
+                        seen_images.add(image_reference_uuid)
+
+                        url = loc['image_urls'].get(image_reference_uuid)
+                        if url is None:
+                            lookups.append(resolver.submit(resolve, image_reference_uuid))
+                        else:
+                            download_queue.put((image_reference_uuid, url))
+
+            for lookup in lookups:
+                lookup.result()  # Raise any lookup error
+        finally:
+            artifact.close()
+
+    stages = [
+        Stage('observations', fetch_observations, observation_queue),
+        Stage('localizations', extract_localizations, download_queue)
+    ]
+
+    # Stage 3 (this thread): URL resolution, file naming and downloads
+    filename_map = {}
+    image_urls = {}
+    basename_urls = {}  # File name -> URL of the first image given that name
+    failures = []
+    n_queued = 0
+    n_existing = 0
+
+    def iter_work():
+        nonlocal n_queued, n_existing
+        for image_reference_uuid, url in iter_queue(download_queue):
+            if url is None:  # Not in the observation, and the lookup failed
+                failures.append((image_reference_uuid, None))
+                continue
+
+            # Name images after their URL. Later images with the same name but a different URL get their UUID appended
+            basename = os.path.basename(url).replace(':', '_')  # Replace : with _ for Windows
+            if transcode_options is not None:
+                basename = transcode_options.path(basename)
+            if basename_urls.setdefault(basename, url) != url:
+                stem, ext = os.path.splitext(basename)
+                basename = '{}_{}{}'.format(stem, image_reference_uuid.lower(), ext)
+            path = os.path.join(images_dir, basename)
+            filename_map[image_reference_uuid] = path
+            image_urls[image_reference_uuid] = url
+
+            if not overwrite and os.path.exists(path):
+                if scale_index is None:
+                    n_existing += 1
+                    if image_reference_uuid not in image_index:  # Backfill (header only)
+                        index_image(image_index, image_reference_uuid, path, checksum=False)
+                    continue
+                if scale_index.get(image_reference_uuid, path) is not None:  # Only transcoded images count
+                    n_existing += 1
+                    continue
+
+            n_queued += 1
+            yield image_reference_uuid, url, path if pool is None else source_path(path, image_reference_uuid)
+
+    journal = DownloadJournal(images_dir)
+    image_index = ImageIndex.for_directory(images_dir)
+    store = ImageStore(store_dir) if store_dir else None
+
+    # Optional stage 3b: resize/re-encode each image in a process pool as soon as it is downloaded
+    scale_index = pool = None
+    if transcode_options is not None:
+        scale_index = ScaleIndex.for_directory(images_dir)
+        pool = TranscodePool(transcode_options, n_transcode_workers)
+
+    def record(image_reference_uuid, path, ok):
+        journal.record(image_reference_uuid, STATE_DONE if ok else STATE_FAILED, path)
+        if not ok:
+            failures.append((image_reference_uuid, image_urls[image_reference_uuid]))
+            del filename_map[image_reference_uuid]
+
+    def record_transcodes(results):
+        for image_reference_uuid, path, result in results:
+            if result is not None:
+                scale_x, scale_y, info = result
+                image_index.add(image_reference_uuid, info)
+                scale_index.add(image_reference_uuid, path, scale_x, scale_y)
+            record(image_reference_uuid, path, result is not None)
+
+    for stage in stages:
+        stage.start()
+
+    with metrics.stage('stream'):
+        t0 = time.time()
+        total_bytes = 0
+        n_done = 0
+        with journal:
+            downloads = iter_downloads(config, iter_work(), n_workers, store=store,
+                                       image_index=image_index if pool is None else None)
+            for image_reference_uuid, url, path, n_bytes in downloads:
+                if n_bytes is not None:
+                    total_bytes += n_bytes
+
+                if pool is None or n_bytes is None:
+                    record(image_reference_uuid, filename_map[image_reference_uuid], n_bytes is not None)
+                else:
+                    pool.submit(image_reference_uuid, path, filename_map[image_reference_uuid])
+                    record_transcodes(pool.completed())
+
+                n_done += 1
+                print_throughput(t0, n_done, n_queued, total_bytes)
+            print()
+
+            if pool is not None:
+                if len(pool):
+                    print('Waiting for {} images to be transcoded...'.format(len(pool)))
+                record_transcodes(pool.finish())
+
+        # Downstream first: a failed stage stops consuming, so its upstream may be blocked on a full queue
+        for stage in reversed(stages):
+            stage.join()
+            if stage.error is not None:
+                raise stage.error
+
+    if store is not None:
+        store.close()
+
+    image_scales = {}
+    if scale_index is not None:
+        scale_index.close()
+        image_scales = {iruuid: scale_index.get(iruuid, path) for iruuid, path in filename_map.items()}
+
+    print('Found {} localizations in {} images'.format(len(localizations), len(filename_map) + len(failures)))
+    print('Downloaded {} images ({} already present), {} failed'.format(
+        len(filename_map) - n_existing, n_existing, len(failures)
+    ))
+    print_cache_stats(config)
+    print_rate_control_stats(config)
+
+    if failures:
+        failures_path = os.path.join(output_dir, DOWNLOAD_FAILURE_FILENAME)
+        with open(failures_path, 'w') as f:
+            f.write('\n'.join('{},{}'.format(iruuid, url or '') for iruuid, url in failures))
+        print('{} failures written to {}'.format(len(failures), failures_path))
+
+    if image_map_path is not None:
+        image_map = {iruuid: image_map_entry(path, image_scales.get(iruuid)) for iruuid, path in filename_map.items()}
+        with open(image_map_path, 'w') as f:
+            json.dump(image_map, f, indent=2, sort_keys=True)
+        print('Image map written to {}'.format(image_map_path))
+
+    # Stage 4: annotations, for the localizations whose image is available
+    with metrics.stage('write'):
+        localizations = [
+            loc for loc in localizations
+            if loc['localization'].get('image_reference_uuid') in filename_map
+        ]
+        table = LocalizationTable.from_localizations(localizations)
+        if image_scales:  # Match the transcoded images
+            table = table.scaled(image_scales)
+
+        if format_type == 'COCO':
+            output_path = os.path.join(output_dir, ANNOTATIONS_NAME + '.' + FORMATS[format_type])
+            now = datetime.now()
+            annotation_record = COCO(images=coco_images(localizations, image_index, filename_map),
+                                     categories=table.concepts,
+                                     year=now.year,
+                                     date_created=str(now))
+            annotation_record.add_annotations(table)
+            annotation_record.write(output_path)
+            print('Wrote COCO annotation record to {}'.format(output_path))
+        else:
+            output_path = os.path.join(output_dir, ANNOTATIONS_NAME)
+            annotation_record = PascalVOC(image_index=image_index)
+            annotation_record.add_annotations(table, filename_map)
+            annotation_record.write(output_path, '{}.' + FORMATS[format_type], n_workers=n_workers)
+            print('Wrote {} VOC XML files to {}'.format(len(annotation_record.annotations), output_path))
+
+    image_index.close()
+
+
+def main(concept, output_dir, config_path, format_type='COCO', include_descendants=False, include_all=False,
+         concurrency=8, n_workers=8, overwrite=False, store_dir=None, digest_path=None, localizations_path=None,
+         image_map_path=None, cache_dir=None, use_cache=True, transcode_options=None, n_transcode_workers=None):
+    if format_type not in FORMATS:
+        print('[ERROR] Invalid format: {}. Options: {}'.format(format_type, formats_str()))
+        exit(1)
+
+    config = Config(config_path)
+    configure_cache(config, cache_dir=cache_dir, enabled=None if use_cache else False)
+
+    try:
+        run_pipeline(config, concept, output_dir, format_type, include_descendants=include_descendants,
+                     include_all=include_all, concurrency=concurrency, n_workers=n_workers, overwrite=overwrite,
+                     store_dir=store_dir, digest_path=digest_path, localizations_path=localizations_path,
+                     image_map_path=image_map_path, transcode_options=transcode_options,
+                     n_transcode_workers=n_transcode_workers)
+    except RuntimeError as e:  # Fatal
+        print('[ERROR] {}'.format(e))
+        exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('concept',
+                        type=str,
+                        help='VARS concept')
+    parser.add_argument('output_dir',
+                        type=str,
+                        help='Output directory (images are written to images/, annotations to annotations.json or '
+                             'annotations/)')
+    parser.add_argument('-c', '--config',
+                        type=str,
+                        default='config.ini',
+                        help='Config path')
+    parser.add_argument('-f', '--format',
+                        type=str,
+                        default='COCO',
+                        help='Localization format to write. Options: ' + formats_str())
+    parser.add_argument('-d', '--descendants',
+                        action='store_true',
+                        help='Flag to include descendants')
+    parser.add_argument('-a', '--all',
+                        action='store_true',
+                        help='Flag to include all other observations for each imaged moment')
+    parser.add_argument('-n', '--concurrency',
+                        type=int,
+                        default=8,
+                        help='Number of concurrent M3 requests for descendant concepts (--descendants), imaged '
+                             'moments (--all) and the URLs of images missing from the observations (default=8)')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=8,
+                        help='Number of download threads, and of processes for writing VOC XML files (default=8)')
+    parser.add_argument('-o', '--overwrite', action='store_true', help='Overwrite existing images')
+    parser.add_argument('-s', '--store',
+                        type=str,
+                        default=None,
+                        help='(optional) Content-addressed image store directory. Images are downloaded once into the '
+                             'store and linked into the output directory')
+    parser.add_argument('--digest',
+                        type=str,
+                        default=None,
+                        help='(optional) Also write the observation digest to this path (.json or .jsonl)')
+    parser.add_argument('--localizations',
+                        type=str,
+                        default=None,
+                        help='(optional) Also write the extracted localizations to this path (.json or .jsonl)')
+    parser.add_argument('--image_map',
+                        type=str,
+                        default=None,
+                        help='(optional) Also write the image filename map to this path')
+    parser.add_argument('--max_side',
+                        type=int,
+                        default=None,
+                        help='(optional) Shrink images so their longest side is at most this many pixels. Boxes are '
+                             'scaled to match')
+    parser.add_argument('--image_format',
+                        type=str.upper,
+                        choices=list(TRANSCODE_FORMATS),
+                        default=None,
+                        help='(optional) Re-encode images to this format')
+    parser.add_argument('--quality',
+                        type=int,
+                        default=DEFAULT_QUALITY,
+                        help='JPEG/WebP quality for resized or re-encoded images (default={})'.format(DEFAULT_QUALITY))
+    parser.add_argument('--transcode_jobs',
+                        type=int,
+                        default=None,
+                        help='Number of processes for resizing/re-encoding images (default=number of CPUs)')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        default=None,
+                        help='M3 response cache directory (overrides the [cache] config section)')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='Disable the M3 response cache')
+    parser.add_argument('--profile',
+                        type=str,
+                        default=None,
+                        help='(optional) Write per-stage wall time and HTTP/JSON/image I/O timings to a JSON report')
+    parser.add_argument('--cprofile',
+                        type=str,
+                        default=None,
+                        help='(optional) Write cProfile stats to a file')
+    args = parser.parse_args()
+
+    transcode = None
+    if args.max_side is not None or args.image_format is not None:
+        transcode = TranscodeOptions(max_side=args.max_side, format=args.image_format, quality=args.quality)
+
+    with metrics.profile(args.profile, args.cprofile):
+        main(args.concept, args.output_dir, args.config, format_type=args.format.upper(),
+             include_descendants=args.descendants, include_all=args.all, concurrency=args.concurrency,
+             n_workers=args.jobs, overwrite=args.overwrite, store_dir=args.store, digest_path=args.digest,
+             localizations_path=args.localizations, image_map_path=args.image_map, cache_dir=args.cache_dir,
+             use_cache=not args.no_cache, transcode_options=transcode, n_transcode_workers=args.transcode_jobs)
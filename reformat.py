@@ -7,9 +7,13 @@ import argparse
 import json
 import os
 from datetime import datetime
+from typing import Optional
 from uuid import UUID
 
-from lib.localization import COCO, PascalVOC
+from lib import metrics
+from lib.image_index import ImageIndex
+from lib.localization import COCO, LocalizationTable, PascalVOC
+from lib.transcode import image_map_path, image_map_scales
 
 FORMATS = {
     'COCO': 'json',
@@ -21,65 +25,92 @@ def formats_str() -> str:
     return ', '.join([f.upper() for f in FORMATS])
 
 
-def main(localizations_path: str, output_name: str, format_type: str, image_map_filename: str):
-    with open(localizations_path) as f:
-        localizations = json.load(f)
+def coco_images(localizations, image_index: Optional[ImageIndex] = None,
+                filename_map: Optional[dict] = None) -> list:
+    """
+    Build the deduplicated COCO image records of the images referenced by localizations
+    File names are the URL basenames, or the downloaded file names if a filename map is given
+    Image sizes are added from the image index, if given
+    """
+    all_images = {}  # (id, file_name) -> image record, for constant-time deduplication
+    for localization in localizations:
+        for image_reference_uuid, url in localization['image_urls'].items():
+            if filename_map is not None:
+                if image_reference_uuid not in filename_map:  # Not downloaded
+                    continue
+                url = filename_map[image_reference_uuid]
+
+            key = (UUID(image_reference_uuid).int, os.path.basename(url))
+            if key not in all_images:
+                all_images[key] = {
+                    'id': key[0],
+                    'file_name': key[1]
+                }
+
+                info = image_index.get(image_reference_uuid) if image_index else None
+                if info is not None:
+                    all_images[key]['width'] = info.width
+                    all_images[key]['height'] = info.height
+
+    return list(all_images.values())
+
+
+def main(localizations_path: str, output_name: str, format_type: str, image_map_filename: str,
+         image_index_filename: Optional[str] = None, n_workers: int = 1):
+    with metrics.stage('load'):
+        with metrics.timer('json.load'), open(localizations_path) as f:
+            localizations = json.load(f)
+        table = LocalizationTable.from_localizations(localizations)
+
+    image_index = ImageIndex(image_index_filename) if image_index_filename else None
+
+    image_map = None
+    if image_map_filename:
+        with open(image_map_filename) as f:
+            image_map = json.load(f)
+
+        # Boxes of resized images (see download_images.py --max_side) are scaled to match
+        image_scales = image_map_scales(image_map)
+        if image_scales:
+            print('Scaling localizations of {} transcoded images'.format(len(image_scales)))
+            table = table.scaled(image_scales)
 
     if format_type == 'COCO':
         output_path = output_name + '.' + FORMATS[format_type]
-        all_images = []
-        all_categories = set()
-        for localization in localizations:
-            for image_reference_uuid, url in localization['image_urls'].items():
-                record = {
-                    'id': UUID(image_reference_uuid).int,
-                    'file_name': os.path.basename(url)
-                }
-                if record not in all_images:
-                    all_images.append(record)
 
-            all_categories.add(localization['concept'])
+        filename_map = None
+        if image_map is not None:  # Use the downloaded file names
+            filename_map = {iruuid: image_map_path(entry) for iruuid, entry in image_map.items()}
 
         now = datetime.now()
-        annotation_record = COCO(images=all_images,
-                                 categories=list(all_categories),
+        annotation_record = COCO(images=coco_images(localizations, image_index, filename_map),
+                                 categories=table.concepts,  # In order of first appearance
                                  year=now.year,
                                  date_created=str(now))
 
-        for localization in localizations:
-            annotation_record.add_annotation(localization)
+        annotation_record.add_annotations(table)
 
-        annotation_record.write(output_path)
+        with metrics.stage('write'):
+            annotation_record.write(output_path)
         print('Wrote COCO annotation record to {}'.format(output_path))
 
     elif format_type == 'VOC':
-        if not image_map_filename:
+        if image_map is None:
             print('[ERROR] Image map argument must be specified for VOC formatting (--image_map)')
             exit(1)
 
-        # Load the image map
-        with open(image_map_filename) as f:
-            image_map = json.load(f)
-
-        iruuid_locs = {}
         for loc in localizations:
             if 'image_reference_uuid' not in loc['localization']:  # Malformed localization, cannot backreference
                 print('[WARNING] Localization with association UUID {} has malformed JSON, skipping'.format(
                     loc['association_uuid']
                 ))
-                continue
-
-            iruuid = loc['localization']['image_reference_uuid']
-            if iruuid not in iruuid_locs:
-                iruuid_locs[iruuid] = []
 
-            iruuid_locs[iruuid].append(loc)
+        with metrics.stage('annotate'):
+            annotation_record = PascalVOC(image_index=image_index)
+            annotation_record.add_annotations(table, image_map)
 
-        annotation_record = PascalVOC()
-        for iruuid, locs in iruuid_locs.items():
-            annotation_record.add_annotation(iruuid, locs, image_map)
-
-        annotation_record.write(output_name, '{}.' + FORMATS[format_type])
+        with metrics.stage('write'):
+            annotation_record.write(output_name, '{}.' + FORMATS[format_type], n_workers=n_workers)
         print('Wrote {} VOC XML files to {}'.format(len(annotation_record.annotations), output_name))
 
     elif format_type in FORMATS:
@@ -87,6 +118,9 @@ def main(localizations_path: str, output_name: str, format_type: str, image_map_
     else:
         print('Invalid format: {}'.format(format_type))
 
+    if image_index is not None:
+        image_index.close()
+
 
 if __name__ == '__main__':
     _parser = argparse.ArgumentParser(description=__doc__)
@@ -103,11 +137,29 @@ if __name__ == '__main__':
                          help='Localization format to write. Options: ' + formats_str())
     _parser.add_argument('--image_map',
                          type=str,
-                         help='Image filename map for VOC formatting (see download_images.py)')
+                         help='Image filename map for VOC formatting (see download_images.py). Optional for COCO: image '
+                              'file names and the scale factors of resized images are taken from it')
+    _parser.add_argument('--image_index',
+                         type=str,
+                         help='(optional) Image metadata index written by download_images.py (image_index.tsv in the '
+                              'image directory). Image sizes are read from it instead of from the images')
+    _parser.add_argument('-j', '--jobs',
+                         type=int,
+                         default=1,
+                         help='Number of processes to use for writing VOC XML files (default=1)')
+    _parser.add_argument('--profile',
+                         type=str,
+                         default=None,
+                         help='(optional) Write per-stage wall time and JSON/XML/image I/O timings to a JSON report')
+    _parser.add_argument('--cprofile',
+                         type=str,
+                         default=None,
+                         help='(optional) Write cProfile stats to a file')
     _args = _parser.parse_args()
 
     _output = _args.output
     if not _output:
         _output = os.path.splitext(_args.localizations)[0] + '_reformatted'
 
-    main(_args.localizations, _output, _args.format.upper(), _args.image_map)
+    with metrics.profile(_args.profile, _args.cprofile):
+        main(_args.localizations, _output, _args.format.upper(), _args.image_map, _args.image_index, _args.jobs)
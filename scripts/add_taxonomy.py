@@ -6,30 +6,58 @@ import argparse
 import glob
 import json
 import os
-import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import List, Optional
-from urllib.request import urlopen
-from urllib.error import URLError
 from urllib.parse import quote
 import xml.etree.ElementTree as ETree
-from xml.dom import minidom
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Repository root, for lib
+
+from lib.cache import configure_cache, get_cache, print_cache_stats  # noqa: E402
+from lib.config import Config  # noqa: E402
+from lib.localization import write_xml  # noqa: E402
+from lib.session import get_session, get_timeout  # noqa: E402
+from lib.voc_index import VOCIndex, scan_concepts  # noqa: E402
 
 TAXONOMY_ENDPOINT = 'http://dsg.mbari.org/kb/v1/phylogeny/basic'
-CONCEPT_REGEX = '<name>.*</name>'
+TAXONOMY_CACHE_ENDPOINT = 'phylogeny/basic'  # Key prefix of taxonomy responses in the response cache
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.ini')
+CHUNK_SIZE = 64  # Files sent to each worker process at a time
+DEFAULT_CONCURRENCY = 8  # Concurrent taxonomy lookups
 
+_concept_taxa_map = {}  # Concept -> taxonomy dict used by worker processes (set by init_worker)
+
+
+def get_basic_taxonomy(config: Config, concept: str):
+    """
+    Call the phylogeny/basic endpoint on a concept and return its response as decoded JSON
+    Responses are served from the response cache when possible
+    """
+    cache = get_cache(config)
+    if cache is not None:
+        data = cache.get(TAXONOMY_CACHE_ENDPOINT, concept)
+        if data is not None:
+            return data
 
-def get_basic_taxonomy(concept: str):
-    """ Call the phylogeny/basic endpoint on a concept and return its response as decoded JSON """
     url = TAXONOMY_ENDPOINT + '/' + quote(concept)
     try:
-        with urlopen(url) as f:
-            return json.load(f)
+        res = get_session(config).get(url, timeout=get_timeout(config))
+        data = res.json()
     except json.JSONDecodeError as e:
         print('[ERROR] Failed to decode JSON in taxonomy response')
         print(e)
-    except URLError as e:
+        return None
+    except requests.RequestException as e:
         print('[ERROR] Failed to fetch taxonomic information for {} at {}'.format(concept, url))
         print(e)
+        return None
+
+    if cache is not None and res.status_code == 200:
+        cache.put(TAXONOMY_CACHE_ENDPOINT, concept, data)
+    return data
 
 
 def extract_taxonomy(taxonomy_json: List[dict]):
@@ -42,60 +70,96 @@ def extract_taxonomy(taxonomy_json: List[dict]):
     return rank_dict
 
 
-def add_taxonomy(voc_paths: List[str], output_dir: Optional[str] = None):
-    """ Add taxonomic information to a list of Pascal VOC annotation files """
-    concept_pattern = re.compile(CONCEPT_REGEX)
+def get_concept_taxa(config: Config, concepts, concurrency: int = DEFAULT_CONCURRENCY) -> dict:
+    """ Fetch the taxonomy of each concept using `concurrency` concurrent requests. Returns concept -> taxonomy dict """
+    def fetch(concept):
+        return concept, get_basic_taxonomy(config, concept)
 
-    all_concepts = set()
-    for voc_path in voc_paths:
-        with open(voc_path) as f:
-            data = f.read()
-            for concept_match in concept_pattern.finditer(data):
-                concept = concept_match[0][6:-7]
-                all_concepts.add(concept)
+    concept_taxa_map = {}
+    with ThreadPoolExecutor(max(concurrency, 1)) as executor:
+        for concept, concept_json in executor.map(fetch, sorted(concepts)):
+            if concept_json is None:
+                continue
+            concept_taxa_map[concept] = extract_taxonomy(concept_json)
 
-    print('[INFO] Identified {} unique concepts. Fetching taxonomic info...'.format(len(all_concepts)))
+    return concept_taxa_map
 
-    concept_taxa_map = {}
-    for concept in all_concepts:
-        concept_json = get_basic_taxonomy(concept)
-        if concept_json is None:
-            continue
 
-        concept_taxa = extract_taxonomy(concept_json)
-        concept_taxa_map[concept] = concept_taxa
+def init_worker(concept_taxa_map: dict):
+    global _concept_taxa_map
+    _concept_taxa_map = concept_taxa_map
 
-    for voc_path in voc_paths:
-        tree = ETree.parse(voc_path)
-        root = tree.getroot()
 
-        objects = root.findall('object')
-        for object_el in objects:
-            concept = object_el.find('name').text
+def annotate_file(voc_path_output_path):
+    """ Parse a VOC annotation file once, add taxonomic information to each object and write it out """
+    voc_path, output_path = voc_path_output_path
+    tree = ETree.parse(voc_path)
+    root = tree.getroot()
 
-            if concept not in concept_taxa_map:
-                continue
+    for object_el in root.findall('object'):
+        concept = object_el.find('name').text
+
+        taxa = _concept_taxa_map.get(concept)
+        if taxa is None:
+            continue
+
+        # Replace any taxonomy from a previous run
+        for old_taxonomy in object_el.findall('taxonomy'):
+            object_el.remove(old_taxonomy)
+
+        taxonomy = ETree.SubElement(object_el, 'taxonomy')
+        for tax_rank, tax_name in taxa.items():
+            tax_data_el = ETree.SubElement(taxonomy, tax_rank)
+            tax_data_el.text = tax_name
+
+    # Write out the XML
+    write_xml(output_path, root)
+
+
+def add_taxonomy(config: Config, voc_paths: List[str], output_dir: Optional[str] = None, n_workers: int = 1,
+                 all_concepts: Optional[set] = None, concurrency: int = DEFAULT_CONCURRENCY):
+    """
+    Add taxonomic information to a list of Pascal VOC annotation files
+    The taxonomy of every concept is fetched concurrently before the files are annotated, so the concepts are found
+    first: from `all_concepts` if given, and otherwise with a raw byte scan of the files (which does not parse them)
+    """
+    if all_concepts is None:
+        all_concepts = set()
+        if n_workers > 1:
+            with ProcessPoolExecutor(n_workers) as executor:
+                for concepts in executor.map(scan_concepts, voc_paths, chunksize=CHUNK_SIZE):
+                    all_concepts.update(concepts)
+        else:
+            for voc_path in voc_paths:
+                all_concepts.update(scan_concepts(voc_path))
+
+    print('[INFO] Identified {} unique concepts. Fetching taxonomic info...'.format(len(all_concepts)))
 
-            taxonomy = ETree.SubElement(object_el, 'taxonomy')
-            for tax_rank, tax_name in concept_taxa_map[concept].items():
-                tax_data_el = ETree.SubElement(taxonomy, tax_rank)
-                tax_data_el.text = tax_name
+    concept_taxa_map = get_concept_taxa(config, all_concepts, concurrency=concurrency)
+    print_cache_stats(config)
 
-        output_path = voc_path
-        if output_dir is not None:
-            output_path = os.path.join(output_dir, os.path.basename(voc_path))
+    jobs = [
+        (voc_path, voc_path if output_dir is None else os.path.join(output_dir, os.path.basename(voc_path)))
+        for voc_path in voc_paths
+    ]
+    if n_workers > 1:  # New workers are forked so they receive the taxonomy map
+        with ProcessPoolExecutor(n_workers, initializer=init_worker, initargs=(concept_taxa_map,)) as executor:
+            for _ in executor.map(annotate_file, jobs, chunksize=CHUNK_SIZE):
+                pass
+    else:
+        init_worker(concept_taxa_map)
+        for job in jobs:
+            annotate_file(job)
 
-        # Write out the XML
-        with open(output_path, 'w') as f:
-            f.write('\n'.join([
-                line for line in minidom.parseString(
-                    ETree.tostring(root, encoding='unicode')
-                ).toprettyxml(indent=' '*4).splitlines()[1:]
-                if line.strip()
-            ]))
+    print('[INFO] Annotated {} files'.format(len(jobs)))
 
 
-def main(input_dir: str, output_dir: Optional[str] = None):
+def main(input_dir: str, output_dir: Optional[str] = None, config_path: str = DEFAULT_CONFIG, n_workers: int = 1,
+         cache_dir: Optional[str] = None, use_cache: bool = True, use_index: bool = False,
+         concurrency: int = DEFAULT_CONCURRENCY):
+    config = Config(config_path)
+    configure_cache(config, cache_dir=cache_dir, enabled=None if use_cache else False)
+
     if not os.path.exists(input_dir) or not os.path.isdir(input_dir):
         print('[ERROR] Input directory {} does not exist'.format(input_dir))
         exit(1)
@@ -108,7 +172,14 @@ def main(input_dir: str, output_dir: Optional[str] = None):
 
     print('[INFO] Found {} annotation XMLs'.format(len(voc_paths)))
 
-    add_taxonomy(voc_paths, output_dir=output_dir)
+    all_concepts = None
+    if use_index:  # Get the concepts from the index instead of scanning the files
+        with VOCIndex(input_dir) as index:
+            index.refresh(n_workers=n_workers)
+            all_concepts = set(index.concepts())
+
+    add_taxonomy(config, voc_paths, output_dir=output_dir, n_workers=n_workers, all_concepts=all_concepts,
+                 concurrency=concurrency)
 
 
 if __name__ == '__main__':
@@ -121,5 +192,30 @@ if __name__ == '__main__':
                          default=None,
                          help='(optional) Output directory for new annotations (if unspecified, original '
                               'annotation files will be overwritten)')
+    _parser.add_argument('-c', '--config',
+                         type=str,
+                         default=DEFAULT_CONFIG,
+                         help='Config path (for HTTP and cache settings)')
+    _parser.add_argument('-j', '--jobs',
+                         type=int,
+                         default=1,
+                         help='Number of processes for scanning and annotation (default=1)')
+    _parser.add_argument('-n', '--concurrency',
+                         type=int,
+                         default=DEFAULT_CONCURRENCY,
+                         help='Number of concurrent taxonomy lookups (default={})'.format(DEFAULT_CONCURRENCY))
+    _parser.add_argument('-i', '--index',
+                         action='store_true',
+                         help='Use (and incrementally refresh) the persistent VOC index in the input directory to find '
+                              'the concepts to look up')
+    _parser.add_argument('--cache-dir',
+                         type=str,
+                         default=None,
+                         help='Response cache directory (overrides the [cache] config section)')
+    _parser.add_argument('--no-cache',
+                         action='store_true',
+                         help='Disable the response cache')
     _args = _parser.parse_args()
-    main(_args.input_dir, _args.output_dir)
+    main(_args.input_dir, _args.output_dir, config_path=_args.config, n_workers=_args.jobs,
+         cache_dir=_args.cache_dir, use_cache=not _args.no_cache, use_index=_args.index,
+         concurrency=_args.concurrency)
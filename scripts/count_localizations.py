@@ -4,110 +4,275 @@ Count localizations per concept in a directory of Pascal VOC annotation XMLs
 """
 
 import os
+import sys
 import glob
+import json
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, List, Optional
 import xml.etree.ElementTree as ETree
 
+import numpy as np
 
-class BoundingBox:
-    """ Simple bounding box class """
-    __slots__ = ['x', 'y', 'w', 'h', 'concept']
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Repository root, for lib
+
+from lib.voc_index import Box, VOCIndex  # noqa: E402
+
+CHUNK_SIZE = 256  # Files (or indexed images) aggregated at a time
+BIN_STEP = 0.25  # Histogram bin width, in powers of 2
+SIZE_BIN_EDGES = np.concatenate(([0.], 2 ** np.arange(0, 16 + BIN_STEP, BIN_STEP)))  # Pixels, up to 65536
+AREA_BIN_EDGES = np.concatenate(([0.], 2 ** np.arange(0, 32 + BIN_STEP, BIN_STEP)))  # Square pixels
+PERCENTILES = (5, 50, 95)
+
+
+def bin_indices(values: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """ Histogram bin index of each value. Values beyond the last edge go into the last bin """
+    return np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+
+
+def hist_percentile(hist: np.ndarray, edges: np.ndarray, q: float) -> float:
+    """ Approximate a percentile from a histogram, interpolating linearly within the bin """
+    cumulative = np.cumsum(hist)
+    if cumulative[-1] == 0:
+        return float('nan')
+
+    target = q / 100 * cumulative[-1]
+    idx = min(int(np.searchsorted(cumulative, target)), len(hist) - 1)
+    below = cumulative[idx - 1] if idx else 0
+    fraction = (target - below) / hist[idx] if hist[idx] else 0
+    return float(edges[idx] + fraction * (edges[idx + 1] - edges[idx]))
 
-    def __init__(self, x: int, y: int,
-                 w: int = None, h: int = None,
-                 x_max: int = None, y_max: int = None,
-                 concept=''):
-        self.x = x
-        self.y = y
-        if w and h:
-            self.w = w
-            self.h = h
-        else:
-            self.w = x_max - x
-            self.h = y_max - y
-        self.concept = concept
 
-    def __iter__(self):
-        yield self.x
-        yield self.y
-        yield self.w
-        yield self.h
+class LocalizationStats:
+    """
+    Aggregate statistics of VOC annotations: per-concept box counts, image counts and histograms of box width,
+    height and area, and the distribution of boxes per image. Boxes are not kept, so statistics can be merged
+    """
+
+    def __init__(self):
+        self.counts = {}  # Concept -> number of boxes
+        self.image_counts = {}  # Concept -> number of images with a box of the concept
+        self.width_hist = {}
+        self.height_hist = {}
+        self.area_hist = {}
+        self.boxes_per_image = np.zeros(1, dtype=np.int64)  # Number of images by number of boxes
 
     @property
-    def corners(self):
-        """ Returns the box in corner format """
-        return self.x, self.y, self.x + self.w, self.y + self.h
+    def n_images(self) -> int:
+        return int(self.boxes_per_image.sum())
+
+    def add_images(self, image_boxes: Iterable[List[Box]]):
+        """ Add the boxes of a batch of images """
+        concept_index = {}
+        inverse = []
+        image_ids = []
+        coords = []
+        n_boxes = []
+        for image_id, boxes in enumerate(image_boxes):
+            n_boxes.append(len(boxes))
+            for concept, *box in boxes:
+                inverse.append(concept_index.setdefault(concept, len(concept_index)))
+                image_ids.append(image_id)
+                coords.append(box)
+
+        self._add_boxes_per_image(np.bincount(np.array(n_boxes, dtype=np.int64), minlength=1))
+        if not coords:
+            return
+
+        # Vectorized per-concept histograms
+        n_concepts = len(concept_index)
+        inverse = np.array(inverse)
+        coords = np.array(coords, dtype=np.float64)
+        widths = coords[:, 2] - coords[:, 0]
+        heights = coords[:, 3] - coords[:, 1]
+
+        counts = np.bincount(inverse, minlength=n_concepts)
+        concept_images = np.unique(np.array(image_ids) * n_concepts + inverse) % n_concepts
+        image_counts = np.bincount(concept_images, minlength=n_concepts)
+
+        hists = {}
+        for attr, values, edges in (('width_hist', widths, SIZE_BIN_EDGES),
+                                    ('height_hist', heights, SIZE_BIN_EDGES),
+                                    ('area_hist', widths * heights, AREA_BIN_EDGES)):
+            hist = np.zeros((n_concepts, len(edges) - 1), dtype=np.int64)
+            np.add.at(hist, (inverse, bin_indices(values, edges)), 1)
+            hists[attr] = hist
+
+        for concept, idx in concept_index.items():
+            self.counts[concept] = self.counts.get(concept, 0) + int(counts[idx])
+            self.image_counts[concept] = self.image_counts.get(concept, 0) + int(image_counts[idx])
+            for attr, hist in hists.items():
+                concept_hists = getattr(self, attr)
+                if concept in concept_hists:
+                    concept_hists[concept] += hist[idx]
+                else:
+                    concept_hists[concept] = hist[idx].copy()
+
+    def _add_boxes_per_image(self, boxes_per_image: np.ndarray):
+        if len(boxes_per_image) > len(self.boxes_per_image):
+            boxes_per_image = boxes_per_image.copy()
+            boxes_per_image[:len(self.boxes_per_image)] += self.boxes_per_image
+            self.boxes_per_image = boxes_per_image
+        else:
+            self.boxes_per_image[:len(boxes_per_image)] += boxes_per_image
+
+    def merge(self, other: 'LocalizationStats'):
+        for concept, count in other.counts.items():
+            self.counts[concept] = self.counts.get(concept, 0) + count
+            self.image_counts[concept] = self.image_counts.get(concept, 0) + other.image_counts[concept]
+            for attr in ('width_hist', 'height_hist', 'area_hist'):
+                concept_hists = getattr(self, attr)
+                hist = getattr(other, attr)[concept]
+                concept_hists[concept] = concept_hists[concept] + hist if concept in concept_hists else hist
+        self._add_boxes_per_image(other.boxes_per_image)
 
     @property
     def json(self):
-        """ Returns a JSON dict representation of the box """
+        """ Returns a JSON dict of the statistics, including the histograms and their bin edges """
         return {
-            'x': self.x,
-            'y': self.y,
-            'width': self.w,
-            'height': self.h
+            'bin_edges': {
+                'size': SIZE_BIN_EDGES.tolist(),
+                'area': AREA_BIN_EDGES.tolist()
+            },
+            'boxes_per_image': self.boxes_per_image.tolist(),
+            'concepts': {
+                concept: {
+                    'count': self.counts[concept],
+                    'images': self.image_counts[concept],
+                    'width': self.width_hist[concept].tolist(),
+                    'height': self.height_hist[concept].tolist(),
+                    'area': self.area_hist[concept].tolist()
+                } for concept in sorted(self.counts)
+            }
         }
 
 
-class RectLabelXML:
-    """ RectLabel XML parser """
-    def __init__(self, path: str):
-        self.path = path
-        self.root = None
-        self.load()
+def read_boxes(path: str) -> List[Box]:
+    """ Stream the boxes of a VOC annotation XML with iterparse, discarding each object once read """
+    boxes = []
+    for _, elem in ETree.iterparse(path):
+        if elem.tag != 'object':
+            continue
+        bndbox = elem.find('bndbox')
+        boxes.append((
+            elem.findtext('name'),
+            float(bndbox.findtext('xmin')),
+            float(bndbox.findtext('ymin')),
+            float(bndbox.findtext('xmax')),
+            float(bndbox.findtext('ymax'))
+        ))
+        elem.clear()
+    return boxes
 
-    def load(self):
-        tree = ETree.parse(self.path)
-        self.root = tree.getroot()
 
-    def get_objects(self):
-        return self.root.findall('object')
+def count_files(xml_files: List[str]) -> LocalizationStats:
+    """ Aggregate the statistics of a chunk of VOC annotation XMLs """
+    image_boxes = []
+    for xml_file in xml_files:
+        try:
+            image_boxes.append(read_boxes(xml_file))
+        except Exception as e:
+            print('[WARNING] Failed to read {}: {}'.format(xml_file, e))
 
-    def get_filename(self):
-        return self.root.find('filename').text
+    stats = LocalizationStats()
+    stats.add_images(image_boxes)
+    return stats
 
-    def read_boxes(self):
-        for obj in self.get_objects():
-            concept = obj.find('name').text
-            bndbox = obj.find('bndbox')
-            x_min = int(bndbox.find('xmin').text)
-            y_min = int(bndbox.find('ymin').text)
-            x_max = int(bndbox.find('xmax').text)
-            y_max = int(bndbox.find('ymax').text)
-            yield BoundingBox(x_min, y_min, x_max=x_max, y_max=y_max, concept=concept)
 
+def count_localizations(directory, n_workers=1) -> LocalizationStats:
+    """ Aggregate localization statistics of a directory, parsing chunks of files in `n_workers` processes """
+    xml_files = sorted(glob.glob(os.path.join(directory, '*.xml')))
+    chunks = [xml_files[i:i + CHUNK_SIZE] for i in range(0, len(xml_files), CHUNK_SIZE)]
 
-def count_localizations(directory):
-    xml_files = glob.glob(os.path.join(directory, '*.xml'))
+    stats = LocalizationStats()
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers) as executor:
+            for chunk_stats in executor.map(count_files, chunks):
+                stats.merge(chunk_stats)
+    else:
+        for chunk in chunks:
+            stats.merge(count_files(chunk))
 
-    concept_map = dict()
-    for xml_file in xml_files:
-        try:
-            rl_xml = RectLabelXML(xml_file)
-            for box in rl_xml.read_boxes():
-                if box.concept not in concept_map:
-                    concept_map[box.concept] = []
-                concept_map[box.concept].append(box)
-        except Exception as e:
-            print(e)
+    return stats
 
-    return concept_map
 
+def count_localizations_indexed(directory, n_workers=1, counts_only=False):
+    """
+    Aggregate localization statistics using the directory's VOC index, refreshing it first
+    If `counts_only` is set, only return the number of localizations per concept
+    """
+    with VOCIndex(directory) as index:
+        index.refresh(n_workers=n_workers)
+        if counts_only:
+            return index.concept_counts()
 
-def main(directory, csv=False, show_total=False):
+        stats = LocalizationStats()
+        annotations = index.iter_annotations()
+        while True:
+            chunk = [boxes for _, _, _, boxes in islice(annotations, CHUNK_SIZE)]
+            if not chunk:
+                break
+            stats.add_images(chunk)
+        return stats
+
+
+def print_stats(stats: LocalizationStats, csv=False):
+    """ Print per-concept image counts and approximate box size percentiles, and the boxes per image """
+    header = ['concept', 'boxes', 'images', 'width_p50', 'height_p50'] + ['area_p{}'.format(q) for q in PERCENTILES]
+    if csv:
+        output_format = ','.join(['{}'] * len(header))
+    else:
+        output_format = '{:<40} : ' + ' '.join(['{:>10}'] * (len(header) - 1))
+
+    print(output_format.format(*header))
+    for concept in sorted(stats.counts):
+        values = [
+            hist_percentile(stats.width_hist[concept], SIZE_BIN_EDGES, 50),
+            hist_percentile(stats.height_hist[concept], SIZE_BIN_EDGES, 50)
+        ] + [hist_percentile(stats.area_hist[concept], AREA_BIN_EDGES, q) for q in PERCENTILES]
+        print(output_format.format(
+            concept, stats.counts[concept], stats.image_counts[concept], *('{:.0f}'.format(v) for v in values)
+        ))
+
+    n_images = stats.n_images
+    n_boxes = int(np.dot(np.arange(len(stats.boxes_per_image)), stats.boxes_per_image))
+    print('[INFO] {} images, {:.2f} boxes per image on average, at most {}'.format(
+        n_images, n_boxes / n_images if n_images else 0, len(stats.boxes_per_image) - 1
+    ))
+
+
+def main(directory, csv=False, show_total=False, use_index=False, n_workers=1, show_stats=False,
+         histogram_path: Optional[str] = None):
     if not os.path.isdir(directory):
         raise Exception('{} is not a valid directory'.format(directory))
 
-    concept_map = count_localizations(directory)
+    stats = None
+    if use_index and not show_stats and histogram_path is None:
+        concept_counts = count_localizations_indexed(directory, n_workers=n_workers, counts_only=True)
+    else:
+        if use_index:
+            stats = count_localizations_indexed(directory, n_workers=n_workers)
+        else:
+            stats = count_localizations(directory, n_workers=n_workers)
+        concept_counts = stats.counts
+
+    if show_stats:
+        print_stats(stats, csv=csv)
+    else:
+        output_format = '{:<40} : {:>5}' if not csv else '{},{}'
 
-    output_format = '{:<40} : {:>5}' if not csv else '{},{}'
+        total = 0
+        for concept in sorted(concept_counts):
+            print(output_format.format(concept, concept_counts[concept]))
+            total += concept_counts[concept]
+        if show_total:
+            print(output_format.format('TOTAL', total))
 
-    total = 0
-    for concept in sorted(concept_map):
-        print(output_format.format(concept, len(concept_map[concept])))
-        total += len(concept_map[concept])
-    if show_total:
-        print(output_format.format('TOTAL', total))
+    if histogram_path is not None:
+        with open(histogram_path, 'w') as f:
+            json.dump(stats.json, f)
+        print('[INFO] Wrote statistics and histograms to {}'.format(histogram_path))
 
 
 if __name__ == '__main__':
@@ -115,6 +280,19 @@ if __name__ == '__main__':
     parser.add_argument('directory', help='Localization directory')
     parser.add_argument('-c', '--csv', action='store_true', help='CSV-formatted output')
     parser.add_argument('-t', '--total', action='store_true', help='Append total of all counts in output')
+    parser.add_argument('-i', '--index',
+                        action='store_true',
+                        help='Use (and incrementally refresh) the persistent VOC index in the directory')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes for parsing (default=1)')
+    parser.add_argument('-s', '--stats',
+                        action='store_true',
+                        help='Print images per concept, approximate box size and area percentiles, and boxes per image')
+    parser.add_argument('--histograms',
+                        type=str,
+                        default=None,
+                        help='(optional) Write the statistics, with box width, height and area histograms, to a JSON '
+                             'file')
     args = parser.parse_args()
 
-    main(args.directory, args.csv, args.total)
+    main(args.directory, args.csv, args.total, use_index=args.index, n_workers=args.jobs, show_stats=args.stats,
+         histogram_path=args.histograms)
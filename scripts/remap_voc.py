@@ -7,9 +7,26 @@ import csv
 import glob
 import json
 import os
-from typing import Optional, List
+import shutil
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from html import unescape
+from typing import Optional, List, Tuple
+from xml.sax.saxutils import escape
 import xml.etree.ElementTree as ETree
-from xml.dom import minidom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Repository root, for lib
+
+from lib.localization import format_xml  # noqa: E402
+from lib.voc_index import OBJECT_NAME_REGEX, OBJECT_REGEX, VOCIndex  # noqa: E402
+
+PARTIAL_SUFFIX = '.part'
+CHUNK_SIZE = 64  # Files sent to each worker process at a time
+
+_mapping = {}  # Concept remapping used by worker processes (set by init_worker)
+_output_dir = None
+_dry_run = False
 
 
 def read_map_file(map_file: str) -> Optional[dict]:
@@ -29,49 +46,109 @@ def read_map_file(map_file: str) -> Optional[dict]:
             return json.load(f)
 
 
-def remap_voc(voc_paths: List[str], mapping: dict, output_dir: Optional[str] = None):
+def init_worker(mapping: dict, output_dir: Optional[str], dry_run: bool):
+    global _mapping, _output_dir, _dry_run
+    _mapping = mapping
+    _output_dir = output_dir
+    _dry_run = dry_run
+
+
+def remap_bytes(data: bytes, mapping: dict) -> Tuple[bytes, Counter]:
     """
-    Remap concepts in a list of VOC annotations according to `mapping`
-    Overwrite files unless `output_dir` is specified
+    Remap the concepts in the raw bytes of a VOC annotation by rewriting only the text of each object's <name> element
+    Other <name> elements (e.g. of <part>s) are left alone. Files with an object whose <name> is not its first child are
+    remapped by parsing them instead
+    Returns the new bytes and the number of boxes remapped per (old concept, new concept)
     """
-    n_modified = 0
+    counts = Counter()
 
-    for voc_path in voc_paths:
-        tree = ETree.parse(voc_path)
-        root = tree.getroot()
+    def replace(match):
+        name = unescape(match.group(2).decode('utf-8'))
+        new_name = mapping.get(name)
+        if new_name is None or new_name == name:
+            return match.group(0)
+        counts[name, new_name] += 1
+        return match.group(1) + escape(new_name).encode('utf-8') + match.group(3)
 
-        modified = False
+    remapped, n_objects = OBJECT_NAME_REGEX.subn(replace, data)
+    if n_objects != len(OBJECT_REGEX.findall(data)):
+        return remap_tree(data, mapping)
+    return remapped, counts
 
-        objects = root.findall('object')
-        for loc in objects:
-            # Get class label name and map index
-            name_tag = loc.find('name')
-            name = name_tag.text
 
-            if name in mapping and name != mapping[name]:
-                name_tag.text = mapping[name]
-                modified = True
+def remap_tree(data: bytes, mapping: dict) -> Tuple[bytes, Counter]:
+    """ Remap the concepts of a VOC annotation by parsing it. Unmodified annotations are returned as they are """
+    root = ETree.fromstring(data)
+    counts = Counter()
 
-        n_modified += modified
+    for object_el in root.findall('object'):
+        name_el = object_el.find('name')
+        if name_el is None:
+            continue
 
-        # Write to output
-        if modified or output_dir is not None:
-            output_path = voc_path
-            if output_dir is not None:
-                output_path = os.path.join(output_dir, os.path.basename(voc_path))
+        name = name_el.text
+        new_name = mapping.get(name)
+        if new_name is None or new_name == name:
+            continue
+        counts[name, new_name] += 1
+        name_el.text = new_name
 
-            with open(output_path, 'w') as f:
-                f.write('\n'.join([
-                    line for line in minidom.parseString(
-                        ETree.tostring(root, encoding='unicode')
-                    ).toprettyxml(indent=' ' * 4).splitlines()[1:]
-                    if line.strip()
-                ]))
+    if not counts:
+        return data, counts
+    return format_xml(root).encode('utf-8'), counts
 
-    print('[INFO] Modified {} annotation XMLs'.format(n_modified))
 
+def remap_file(voc_path: str) -> Counter:
+    """ Remap the concepts in a VOC annotation file and write it out atomically (unless in a dry run) """
+    with open(voc_path, 'rb') as f:
+        data = f.read()
 
-def main(map_file: str, input_dir: str, output_dir: Optional[str] = None):
+    data, counts = remap_bytes(data, _mapping)
+
+    # Write to output
+    if not _dry_run and (counts or _output_dir is not None):
+        output_path = voc_path
+        if _output_dir is not None:
+            output_path = os.path.join(_output_dir, os.path.basename(voc_path))
+
+        temp_path = output_path + PARTIAL_SUFFIX
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, output_path)
+
+    return counts
+
+
+def remap_voc(voc_paths: List[str], mapping: dict, output_dir: Optional[str] = None, n_workers: int = 1,
+              dry_run: bool = False) -> Counter:
+    """
+    Remap concepts in a list of VOC annotations according to `mapping`, in `n_workers` processes
+    Overwrite files unless `output_dir` is specified, and write nothing if `dry_run` is set
+    Returns the number of boxes remapped per (old concept, new concept)
+    """
+    n_modified = 0
+    total_counts = Counter()
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers, initializer=init_worker, initargs=(mapping, output_dir, dry_run)) as executor:
+            results = list(executor.map(remap_file, voc_paths, chunksize=CHUNK_SIZE))
+    else:
+        init_worker(mapping, output_dir, dry_run)
+        results = map(remap_file, voc_paths)
+
+    for counts in results:
+        n_modified += bool(counts)
+        total_counts.update(counts)
+
+    print('[INFO] {} {} boxes in {} annotation XMLs'.format(
+        'Would remap' if dry_run else 'Remapped', sum(total_counts.values()), n_modified
+    ))
+
+    return total_counts
+
+
+def main(map_file: str, input_dir: str, output_dir: Optional[str] = None, use_index: bool = False, n_workers: int = 1,
+         dry_run: bool = False):
     concept_map = read_map_file(map_file)
     if concept_map is None:
         print('[ERROR] Invalid map file extension')
@@ -81,15 +158,32 @@ def main(map_file: str, input_dir: str, output_dir: Optional[str] = None):
         print('[ERROR] Input directory {} does not exist'.format(input_dir))
         exit(1)
 
-    if output_dir is not None and not os.path.exists(output_dir):
+    if output_dir is not None and not dry_run and not os.path.exists(output_dir):
         os.makedirs(output_dir, exist_ok=True)
         print('[INFO] Created output directory {}'.format(output_dir))
 
-    voc_paths = glob.glob(os.path.join(input_dir, '*.xml'))
+    voc_paths = sorted(glob.glob(os.path.join(input_dir, '*.xml')))
 
     print('[INFO] Found {} annotation XMLs'.format(len(voc_paths)))
 
-    remap_voc(voc_paths, concept_map, output_dir=output_dir)
+    if use_index:  # Only parse files that contain a concept to remap
+        with VOCIndex(input_dir) as index:
+            index.refresh(n_workers=n_workers)
+            candidates = set(index.paths_with_concepts(k for k, v in concept_map.items() if k != v))
+
+        if output_dir is not None and not dry_run:  # Copy the untouched files as-is
+            for voc_path in voc_paths:
+                if voc_path not in candidates:
+                    shutil.copyfile(voc_path, os.path.join(output_dir, os.path.basename(voc_path)))
+
+        voc_paths = [voc_path for voc_path in voc_paths if voc_path in candidates]
+        print('[INFO] {} annotation XMLs contain concepts to remap'.format(len(voc_paths)))
+
+    counts = remap_voc(voc_paths, concept_map, output_dir=output_dir, n_workers=n_workers, dry_run=dry_run)
+
+    if dry_run:
+        for (name, new_name), count in sorted(counts.items()):
+            print('{:<40} -> {:<40} : {:>5}'.format(name, new_name, count))
 
 
 if __name__ == '__main__':
@@ -105,5 +199,17 @@ if __name__ == '__main__':
                          default=None,
                          help='(optional) Output directory for remapped annotations (if unspecified, original '
                               'annotation files will be overwritten)')
+    _parser.add_argument('-i', '--index',
+                         action='store_true',
+                         help='Use (and incrementally refresh) the persistent VOC index in the input directory to skip '
+                              'files without concepts to remap')
+    _parser.add_argument('-j', '--jobs',
+                         type=int,
+                         default=1,
+                         help='Number of processes for remapping and refreshing the index (default=1)')
+    _parser.add_argument('--dry_run',
+                         action='store_true',
+                         help='Only report how many boxes of each concept would be remapped, without writing files')
     _args = _parser.parse_args()
-    main(_args.map_file, _args.input_dir, _args.output_dir)
+    main(_args.map_file, _args.input_dir, _args.output_dir, use_index=_args.index, n_workers=_args.jobs,
+         dry_run=_args.dry_run)
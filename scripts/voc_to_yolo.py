@@ -5,73 +5,143 @@ Convert Pascal VOC annotation XMLs to YOLO format
 import argparse
 import glob
 import os
-from typing import List
-import xml.etree.ElementTree as ETree
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional, Tuple, Union
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Repository root, for lib
 
-def format_line(object_id, center_x, center_y, width, height):
-    """ Format an output line for a YOLO annotation file """
-    return '{} {} {} {} {}'.format(object_id, center_x, center_y, width, height)
-
-
-def convert_voc_to_yolo(voc_paths: List[str], output_dir: str):
-    """ Convert VOC annotations to YOLO and write to `output_dir` """
-    names = {}  # Map of class names (written to yolo.names)
-
-    for voc_path in voc_paths:
-        lines = []
-
-        tree = ETree.parse(voc_path)
-        root = tree.getroot()
+from lib.voc_index import Box, VOCIndex, parse_voc, scan_concepts  # noqa: E402
 
-        # Get image size
-        size = root.find('size')
-        image_width = int(size.find('width').text)
-        image_height = int(size.find('height').text)
+NAMES_FILENAME = 'yolo.names'
+PARTIAL_SUFFIX = '.part'
+CHUNK_SIZE = 64  # Files sent to each worker process at a time
 
-        # Compute scaling values
-        scale_x = 1 / image_width
-        scale_y = 1 / image_height
+Annotation = Tuple[str, int, int, List[Box]]  # VOC path, image width, image height, boxes
 
-        objects = root.findall('object')
-        for loc in objects:
-            # Get class label name and map index
-            name = loc.find('name').text
-            if name not in names:
-                names[name] = len(names)
-            name_idx = names[name]
+_names = {}  # Class name -> index used by worker processes (set by init_worker)
+_output_dir = None
 
-            # Get box position and size
-            box = loc.find('bndbox')
-            x = float(box.find('xmin').text)
-            y = float(box.find('ymin').text)
-            width = float(box.find('xmax').text) - x
-            height = float(box.find('ymax').text) - y
 
-            # Compute scaled YOLO quantities
-            scaled_center_x = (x + width / 2) * scale_x
-            scaled_center_y = (y + height / 2) * scale_y
-            scaled_width = width * scale_x
-            scaled_height = height * scale_y
-
-            lines.append(format_line(name_idx, scaled_center_x, scaled_center_y, scaled_width, scaled_height) + '\n')
+def format_line(object_id, center_x, center_y, width, height):
+    """ Format an output line for a YOLO annotation file """
+    return '{} {} {} {} {}'.format(object_id, center_x, center_y, width, height)
 
-        # Write to output
-        output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(voc_path))[0] + '.txt')
-        with open(output_path, 'w') as f:
-            f.writelines(lines)
 
-    print('[INFO] Wrote {} output YOLO annotation files to {}'.format(len(voc_paths), output_dir))
+def read_voc(voc_path: str) -> Annotation:
+    """ Read the image size and boxes of a VOC annotation XML """
+    _, image_width, image_height, _, boxes = parse_voc(voc_path)
+    return voc_path, image_width, image_height, boxes
+
+
+def read_names(names_path: str) -> List[str]:
+    """ Read class names, one per line, from a names file """
+    with open(names_path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def write_atomic(path: str, lines: List[str]):
+    """ Write lines to a temporary file and move it into place """
+    temp_path = path + PARTIAL_SUFFIX
+    with open(temp_path, 'w') as f:
+        f.writelines(lines)
+    os.replace(temp_path, path)
+
+
+def init_worker(names: dict, output_dir: str):
+    global _names, _output_dir
+    _names = names
+    _output_dir = output_dir
+
+
+def convert_annotation(annotation: Union[str, Annotation]) -> int:
+    """
+    Convert one VOC annotation (a path, or an already parsed annotation) to YOLO and write it to the output directory
+    Returns the number of boxes skipped because their class is not in the class names
+    """
+    if isinstance(annotation, str):
+        annotation = read_voc(annotation)
+    voc_path, image_width, image_height, boxes = annotation
+
+    # Compute scaling values
+    scale_x = 1 / image_width
+    scale_y = 1 / image_height
+
+    lines = []
+    n_skipped = 0
+    for name, x, y, x_max, y_max in boxes:
+        # Get class label index
+        name_idx = _names.get(name)
+        if name_idx is None:
+            n_skipped += 1
+            continue
+
+        # Get box size
+        width = x_max - x
+        height = y_max - y
+
+        # Compute scaled YOLO quantities
+        scaled_center_x = (x + width / 2) * scale_x
+        scaled_center_y = (y + height / 2) * scale_y
+        scaled_width = width * scale_x
+        scaled_height = height * scale_y
+
+        lines.append(format_line(name_idx, scaled_center_x, scaled_center_y, scaled_width, scaled_height) + '\n')
+
+    # Write to output
+    output_path = os.path.join(_output_dir, os.path.splitext(os.path.basename(voc_path))[0] + '.txt')
+    write_atomic(output_path, lines)
+
+    return n_skipped
+
+
+def scan_names(voc_paths: List[str], n_workers: int = 1) -> List[str]:
+    """ Find the class names in a list of VOC annotation files (byte scan, in `n_workers` processes), sorted """
+    names = set()
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers) as executor:
+            for concepts in executor.map(scan_concepts, voc_paths, chunksize=CHUNK_SIZE):
+                names.update(concepts)
+    else:
+        for voc_path in voc_paths:
+            names.update(scan_concepts(voc_path))
+    return sorted(names)
+
+
+def convert_voc_to_yolo(annotations: Iterable[Union[str, Annotation]], output_dir: str, names: List[str],
+                        n_workers: int = 1):
+    """
+    Convert VOC annotations (paths, or parsed (path, image width, image height, boxes)) to YOLO and write to
+    `output_dir` in `n_workers` processes. Class indices are the positions of the class names in `names`
+    """
+    names_map = {name: idx for idx, name in enumerate(names)}
+
+    n_files = 0
+    n_skipped = 0
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers, initializer=init_worker, initargs=(names_map, output_dir)) as executor:
+            for skipped in executor.map(convert_annotation, annotations, chunksize=CHUNK_SIZE):
+                n_files += 1
+                n_skipped += skipped
+    else:
+        init_worker(names_map, output_dir)
+        for annotation in annotations:
+            n_skipped += convert_annotation(annotation)
+            n_files += 1
+
+    print('[INFO] Wrote {} output YOLO annotation files to {}'.format(n_files, output_dir))
+    if n_skipped:
+        print('[WARNING] Skipped {} boxes with classes not in the class names'.format(n_skipped))
 
     # Write class name map to yolo.names
-    reverse_names = {idx: name for name, idx in names.items()}
-    with open('../yolo.names', 'w') as f:
-        f.writelines([reverse_names[idx] + '\n' for idx in range(len(reverse_names))])
+    names_path = os.path.join(output_dir, NAMES_FILENAME)
+    write_atomic(names_path, [name + '\n' for name in names])
 
-    print('[INFO] Wrote yolo.names')
+    print('[INFO] Wrote {}'.format(names_path))
 
 
-def main(input_dirs: List[str], output_dir: str):
+def main(input_dirs: List[str], output_dir: str, use_index: bool = False, n_workers: int = 1,
+         names_path: Optional[str] = None):
     # Check for existence of input directories
     valid_input_dirs = filter(os.path.exists, input_dirs)
     valid_input_dirs = list(filter(os.path.isdir, valid_input_dirs))
@@ -84,16 +154,37 @@ def main(input_dirs: List[str], output_dir: str):
         os.makedirs(output_dir, exist_ok=True)
         print('[INFO] Created output directory {}'.format(output_dir))
 
-    # Collect all VOC XML file paths in all directories
-    voc_paths = []
-    for input_dir in valid_input_dirs:
-        xml_paths = glob.glob(os.path.join(input_dir, '*.xml'))
-        voc_paths.extend(xml_paths)
-
-    print('[INFO] Found {} annotation XMLs in {} directories'.format(len(voc_paths), len(valid_input_dirs)))
+    names = None
+    if names_path is not None:
+        names = read_names(names_path)
+        print('[INFO] Read {} class names from {}'.format(len(names), names_path))
+
+    if use_index:  # Read sizes and boxes from each directory's index, re-parsing only changed XMLs
+        annotations = []
+        index_names = set()
+        for input_dir in valid_input_dirs:
+            with VOCIndex(input_dir) as index:
+                index.refresh(n_workers=n_workers)
+                annotations.extend(index.iter_annotations())
+                index_names.update(index.concepts())
+        print('[INFO] Found {} indexed annotation XMLs in {} directories'.format(len(annotations), len(valid_input_dirs)))
+        if names is None:
+            names = sorted(index_names)
+    else:
+        # Collect all VOC XML file paths in all directories
+        annotations = []
+        for input_dir in valid_input_dirs:
+            xml_paths = glob.glob(os.path.join(input_dir, '*.xml'))
+            annotations.extend(sorted(xml_paths))
+
+        print('[INFO] Found {} annotation XMLs in {} directories'.format(len(annotations), len(valid_input_dirs)))
+        if names is None:  # Pre-pass for a deterministic class index
+            names = scan_names(annotations, n_workers=n_workers)
+
+    print('[INFO] Using {} classes'.format(len(names)))
 
     # Convert and write
-    convert_voc_to_yolo(voc_paths, output_dir)
+    convert_voc_to_yolo(annotations, output_dir, names, n_workers=n_workers)
 
 
 if __name__ == '__main__':
@@ -105,5 +196,17 @@ if __name__ == '__main__':
     _parser.add_argument('input_dir',
                          nargs='+',
                          help='Input directory of VOC annotation XMLs')
+    _parser.add_argument('-n', '--names',
+                         type=str,
+                         default=None,
+                         help='(optional) Class names file, one per line, giving the class indices (if unspecified, '
+                              'all classes found in the input are used, sorted by name)')
+    _parser.add_argument('-i', '--index',
+                         action='store_true',
+                         help='Use (and incrementally refresh) the persistent VOC index in each input directory')
+    _parser.add_argument('-j', '--jobs',
+                         type=int,
+                         default=1,
+                         help='Number of processes for parsing and conversion (default=1)')
     _args = _parser.parse_args()
-    main(_args.input_dir, _args.output_dir)
+    main(_args.input_dir, _args.output_dir, use_index=_args.index, n_workers=_args.jobs, names_path=_args.names)